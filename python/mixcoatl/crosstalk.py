@@ -6,11 +6,12 @@ images.
 """
 
 import numpy as np
+from collections import OrderedDict
 from astropy.io import fits
 
 from lsst.eotest.fitsTools import fitsWriteto
 
-def rectangular_mask(imarr, y_center, x_center, lx, ly):
+def rectangular_mask(imarr, y_center, x_center, lx, ly, region=False):
     """Make a rectangular pixel mask.
 
     Parameters
@@ -25,19 +26,32 @@ def rectangular_mask(imarr, y_center, x_center, lx, ly):
         Length of rectangle along X-axis.
     ly : `int`
         Length of rectangle along Y-axis.
+    region : `bool`
+        `True` to return a region descriptor instead of a full-frame mask.
 
     Returns
     -------
-    mask : `numpy.ndarray`, (Ny, Nx)
-        2-D mask boolean array.
+    mask : `numpy.ndarray`, (Ny, Nx), or `tuple`
+        2-D mask boolean array, or region descriptor (bbox, mask) if 
+        ``region`` is `True`.
     """
     Ny, Nx = imarr.shape
+
+    if region:
+        y_min = max(int(np.ceil(y_center - ly/2.)), 0)
+        y_max = min(int(np.floor(y_center + ly/2.)) + 1, Ny)
+        x_min = max(int(np.ceil(x_center - lx/2.)), 0)
+        x_max = min(int(np.floor(x_center + lx/2.)) + 1, Nx)
+        bbox = (slice(y_min, max(y_max, y_min)), slice(x_min, max(x_max, x_min)))
+
+        return bbox, None
+
     Y, X = np.ogrid[:Ny, :Nx]
     mask = (np.abs(Y - y_center) > ly/2.) | (np.abs(X - x_center) > lx/2.)
 
     return mask
 
-def satellite_mask(imarr, angle, distance, width):
+def satellite_mask(imarr, angle, distance, width, region=False):
     """Make a pixel mask along a target line.
 
     Parameters
@@ -51,18 +65,69 @@ def satellite_mask(imarr, angle, distance, width):
         Distance from the origin to the closest point on the target line.
     width : `float`
         Width of the mask extending from either side of the target line.
+    region : `bool`
+        `True` to return a region descriptor instead of a full-frame mask.
 
     Returns
     -------
-    mask : `numpy.ndarray`, (Ny, Nx)
-        2-D mask boolean array.
+    mask : `numpy.ndarray`, (Ny, Nx), or `tuple`
+        2-D mask boolean array, or region descriptor (bbox, mask) if 
+        ``region`` is `True`.
     """
     Ny, Nx = imarr.shape
+
+    if region:
+
+        ## Bound the target line within the image
+        c, s = np.cos(angle), np.sin(angle)
+        y_min, y_max, x_min, x_max = 0, Ny, 0, Nx
+        if np.abs(c) > 1E-8:
+            x_edges = [(distance + sign*width - y*s)/c for sign in (-1, 1) for y in (0, Ny-1)]
+            x_min = max(x_min, int(np.floor(min(x_edges))))
+            x_max = min(x_max, int(np.ceil(max(x_edges))) + 1)
+        if np.abs(s) > 1E-8:
+            y_edges = [(distance + sign*width - x*c)/s for sign in (-1, 1) for x in (0, Nx-1)]
+            y_min = max(y_min, int(np.floor(min(y_edges))))
+            y_max = min(y_max, int(np.ceil(max(y_edges))) + 1)
+        bbox = (slice(y_min, max(y_max, y_min)), slice(x_min, max(x_max, x_min)))
+
+        Y, X = np.ogrid[bbox]
+        mask = np.abs((X*c + Y*s) - distance) > width
+
+        return bbox, mask
+
     Y, X = np.ogrid[:Ny, :Nx]
     mask = np.abs((X*np.cos(angle) + Y*np.sin(angle)) - distance) > width
 
     return mask
 
+def mask_to_region(mask):
+    """Convert a full-frame pixel mask to a region descriptor.
+
+    Parameters
+    ----------
+    mask : `numpy.ndarray`, (Ny, Nx)
+        2-D mask boolean array.
+
+    Returns
+    -------
+    region : `tuple`
+        Region descriptor (bbox, mask), where bbox is a tuple of slices
+        bounding the unmasked pixels and mask is the 2-D mask boolean array
+        within the bounding box, or `None` if no pixels are masked.
+    """
+    rows = np.flatnonzero(~np.all(mask, axis=1))
+    cols = np.flatnonzero(~np.all(mask, axis=0))
+    if rows.shape[0] == 0:
+        return (slice(0, 0), slice(0, 0)), None
+
+    bbox = (slice(int(rows[0]), int(rows[-1])+1), slice(int(cols[0]), int(cols[-1])+1))
+    box_mask = mask[bbox]
+    if not box_mask.any():
+        box_mask = None
+
+    return bbox, box_mask
+
 def circular_mask(imarr, y_center, x_center, radius):
     """Make a circular pixel mask.
 
@@ -116,9 +181,12 @@ def crosstalk_model(params, aggressor_imarr):
     
     return model
 
-def crosstalk_fit(aggressor_stamp, victim_stamp, mask, noise=7.0):
+def crosstalk_fit(aggressor_stamp, victim_stamp, mask=None, noise=7.0, num_iter=1, nsig=5.0):
     """Perform crosstalk victim model least-squares minimization.
 
+    If more than one iteration is requested, pixels with residuals larger
+    than ``nsig`` times the residual standard deviation (e.g. cosmic rays 
+    and hot pixels) are rejected and the solution is updated.
 
     Parameters
     ----------
@@ -126,10 +194,15 @@ def crosstalk_fit(aggressor_stamp, victim_stamp, mask, noise=7.0):
         2-D aggressor postage stamp pixel array.
     victim_stamp: `numpy.ndarray`, (Ny, Nx)
         2-D victim postage stamp pixel array.
-    mask: `numpy.ndarray`, (Ny, Nx)
-        2-D mask boolean array.
+    mask: `numpy.ndarray`, (Ny, Nx), or `tuple`, optional
+        2-D mask boolean array, or region descriptor (bbox, mask).  All
+        pixels are used if `None`.
     noise : `float`
         Image read noise.
+    num_iter : `int`
+        Number of least-squares iterations.
+    nsig : `float`
+        Outlier rejection sigma threshold.
 
     Returns
     -------
@@ -146,27 +219,256 @@ def crosstalk_fit(aggressor_stamp, victim_stamp, mask, noise=7.0):
         - Sum of residuals.
         - Reduced degrees of freedom.
     """    
+    results = crosstalk_fit_many(aggressor_stamp, [victim_stamp], mask, noise=noise,
+                                 num_iter=num_iter, nsig=nsig)
 
-    victim_imarr = np.ma.masked_where(mask, victim_stamp)
+    return results[0]
 
-    ## Construct masked, compressed basis arrays
-    ay, ax = aggressor_stamp.shape
-    Z = np.ma.masked_where(mask, np.ones((ay, ax))).compressed()
-    Y, X = np.mgrid[:ay, :ax]
-    Y = np.ma.masked_where(mask, Y).compressed()
-    X = np.ma.masked_where(mask, X).compressed()
-    aggressor_imarr = np.ma.masked_where(mask, aggressor_stamp).compressed()
+def crosstalk_fit_many(aggressor_stamp, victim_stamps, mask=None, noise=7.0, num_iter=1, nsig=5.0,
+                       engine=None):
+    """Perform crosstalk victim model least-squares minimization for many victims.
 
-    ## Perform least squares parameter estimation
-    b = victim_imarr.compressed()/noise
-    A = np.vstack([aggressor_imarr, Z, Y, X]).T/noise
-    params, res, rank, s = np.linalg.lstsq(A, b, rcond=-1)
-    covar = np.linalg.inv(np.dot(A.T, A))
-    dof = b.shape[0] - 4
+    The normal equations are assembled once from the aggressor postage stamp
+    and the least-squares solution is found for all victim postage stamps
+    simultaneously.
 
-    results = np.concatenate((params, np.sqrt(covar.diagonal()), res, [dof]))
-    
-    return results
+    Parameters
+    ----------
+    aggressor_stamp: `numpy.ndarray`, (Ny, Nx)
+        2-D aggressor postage stamp pixel array.
+    victim_stamps: `numpy.ndarray`, (N, Ny, Nx)
+        Victim postage stamp pixel arrays, either as a 3-D array or as a
+        sequence of 2-D arrays.
+    mask: `numpy.ndarray`, (Ny, Nx), or `tuple`, optional
+        2-D mask boolean array, or region descriptor (bbox, mask).  Only
+        the pixels within the region bounding box are used in the fit.  All
+        pixels are used if `None`.
+    noise : `float`
+        Image read noise.
+    num_iter : `int`
+        Number of least-squares iterations.
+    nsig : `float`
+        Outlier rejection sigma threshold.
+    engine : `CrosstalkFitEngine`, optional
+        Fit engine used to cache region geometry.  The module default engine
+        is used if `None`.
+
+    Returns
+    -------
+    results : `numpy.ndarray`, (N, 10)
+        Results of least-squares minimization for each victim, with the
+        same columns as `crosstalk_fit`.
+    """
+    if engine is None:
+        engine = _default_engine
+
+    return engine.fit(aggressor_stamp, victim_stamps, mask, noise=noise, num_iter=num_iter, nsig=nsig)
+
+class CrosstalkFitEngine():
+    """Crosstalk victim model least-squares solver with cached geometry.
+
+    The constant offset and tilt columns of the victim model design matrix
+    depend only on the shape of the region bounding box and the in-box mask.
+    For each region geometry the compressed basis arrays and their Gram
+    matrix are cached, with least recently used eviction within a memory 
+    budget, and the normal 
+    equations are assembled from these blocks and the aggressor and victim 
+    pixel dot products.
+
+    For iterative outlier rejection, the normal equations of each victim are
+    downdated by removing only the newly rejected pixels at each iteration.
+
+    Parameters
+    ----------
+    max_size : `float`
+        Memory budget (MB) for cached region geometries.  A geometry larger
+        than the budget is not cached.
+    """
+
+    def __init__(self, max_size=64.):
+
+        self.max_size = max_size
+        self.nbytes = 0
+        self._cache = OrderedDict()
+
+    def clear(self):
+        """Remove all cached region geometries."""
+        self._cache.clear()
+        self.nbytes = 0
+
+    def get_geometry(self, shape, box_mask=None):
+        """Return the cached basis arrays for a region geometry.
+
+        Parameters
+        ----------
+        shape : `tuple`
+            Shape of the region bounding box.
+        box_mask : `numpy.ndarray`, optional
+            2-D mask boolean array within the bounding box.
+
+        Returns
+        -------
+        keep : `numpy.ndarray` or `None`
+            Flattened indices of unmasked pixels, or `None` for all pixels.
+        basis : `numpy.ndarray`, (M, 3)
+            Constant, Y-axis and X-axis basis columns, in bounding box 
+            coordinates, for the M unmasked pixels.
+        gram : `numpy.ndarray`, (3, 3)
+            Gram matrix of the basis columns.
+        """
+        if box_mask is None:
+            key = (tuple(shape), None)
+        else:
+            key = (tuple(shape), np.packbits(box_mask).tobytes())
+
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        ## Construct compressed basis arrays
+        Y, X = np.mgrid[:shape[0], :shape[1]]
+        if box_mask is None:
+            keep = None
+            Y = Y.ravel()
+            X = X.ravel()
+        else:
+            keep = np.flatnonzero(~box_mask.ravel())
+            Y = Y.ravel()[keep]
+            X = X.ravel()[keep]
+        basis = np.stack([np.ones(Y.shape[0]), Y, X], axis=1).astype(float)
+        gram = np.dot(basis.T, basis)
+
+        geometry = (keep, basis, gram)
+        nbytes = basis.nbytes + gram.nbytes + (keep.nbytes if keep is not None else 0)
+        max_bytes = self.max_size*1024*1024
+        if nbytes > max_bytes:
+            return geometry
+
+        ## Evict least recently used geometries to fit within budget
+        while self._cache and self.nbytes + nbytes > max_bytes:
+            old_keep, old_basis, old_gram = self._cache.popitem(last=False)[1]
+            self.nbytes -= old_basis.nbytes + old_gram.nbytes \
+                + (old_keep.nbytes if old_keep is not None else 0)
+        self._cache[key] = geometry
+        self.nbytes += nbytes
+
+        return geometry
+
+    def fit(self, aggressor_stamp, victim_stamps, mask=None, noise=7.0, num_iter=1, nsig=5.0):
+        """Perform crosstalk victim model least-squares minimization.
+
+        Parameters
+        ----------
+        aggressor_stamp: `numpy.ndarray`, (Ny, Nx)
+            2-D aggressor postage stamp pixel array.
+        victim_stamps: `numpy.ndarray`, (N, Ny, Nx)
+            Victim postage stamp pixel arrays.
+        mask: `numpy.ndarray`, (Ny, Nx), or `tuple`, optional
+            2-D mask boolean array, or region descriptor (bbox, mask).
+        noise : `float`
+            Image read noise.
+        num_iter : `int`
+            Number of least-squares iterations.
+        nsig : `float`
+            Outlier rejection sigma threshold.
+
+        Returns
+        -------
+        results : `numpy.ndarray`, (N, 10)
+            Results of least-squares minimization for each victim, with the
+            same columns as `crosstalk_fit`.
+        """
+        if mask is None:
+            Ny, Nx = aggressor_stamp.shape
+            bbox, box_mask = (slice(0, Ny), slice(0, Nx)), None
+        elif isinstance(mask, tuple):
+            bbox, box_mask = mask
+        else:
+            bbox, box_mask = mask_to_region(mask)
+
+        aggressor_box = aggressor_stamp[bbox]
+        keep, basis, gram = self.get_geometry(aggressor_box.shape, box_mask)
+
+        ## Compressed aggressor and victim pixel arrays
+        aggressor_imarr = np.asarray(aggressor_box, dtype=float).ravel()
+        victim_imarrs = np.stack([np.asarray(victim_stamp[bbox], dtype=float).ravel() 
+                                  for victim_stamp in victim_stamps])
+        if keep is not None:
+            aggressor_imarr = aggressor_imarr[keep]
+            victim_imarrs = victim_imarrs[:, keep]
+        nvictims, npixels = victim_imarrs.shape
+
+        ## Assemble normal equations from cached blocks
+        normal = np.empty((4, 4))
+        normal[0, 0] = np.dot(aggressor_imarr, aggressor_imarr)
+        normal[0, 1:] = normal[1:, 0] = np.dot(basis.T, aggressor_imarr)
+        normal[1:, 1:] = gram
+        normals = np.repeat(normal[np.newaxis, :, :], nvictims, axis=0)
+        rhs = np.empty((nvictims, 4))
+        rhs[:, 0] = np.dot(victim_imarrs, aggressor_imarr)
+        rhs[:, 1:] = np.dot(victim_imarrs, basis)
+
+        params, normals_inv = self._solve(normals, rhs)
+        residuals = victim_imarrs - np.outer(params[:, 0], aggressor_imarr) - np.dot(params[:, 1:], basis.T)
+        ndata = np.full(nvictims, npixels)
+
+        ## Iteratively reject outliers and downdate normal equations
+        rejected = np.zeros((nvictims, npixels), dtype=bool)
+        for n in range(num_iter-1):
+
+            sigma = np.sqrt(np.sum(np.square(residuals), axis=1)/np.maximum(ndata-4, 1))
+            outliers = (np.abs(residuals) > nsig*sigma[:, np.newaxis]) & ~rejected
+            updated = np.flatnonzero(outliers.any(axis=1))
+            if updated.shape[0] == 0:
+                break
+
+            for v in updated:
+                idx = np.flatnonzero(outliers[v])
+                A = np.column_stack([aggressor_imarr[idx], basis[idx]])
+                normals[v] -= np.dot(A.T, A)
+                rhs[v] -= np.dot(A.T, victim_imarrs[v, idx])
+            rejected |= outliers
+            ndata[updated] -= outliers[updated].sum(axis=1)
+
+            params[updated], normals_inv[updated] = self._solve(normals[updated], rhs[updated])
+            residuals[updated] = victim_imarrs[updated] - np.outer(params[updated, 0], aggressor_imarr) \
+                - np.dot(params[updated, 1:], basis.T)
+            residuals[rejected] = 0.
+
+        chisq = np.sum(np.square(residuals), axis=1)/noise**2
+        covar = normals_inv*noise**2
+        dof = ndata - 4
+
+        ## Transform offset from bounding box to pixel coordinates
+        y0, x0 = bbox[0].start or 0, bbox[1].start or 0
+        transform = np.identity(4)
+        transform[1, 2] = -y0
+        transform[1, 3] = -x0
+        params = np.dot(params, transform.T)
+        covar = np.matmul(transform, np.matmul(covar, transform.T))
+
+        results = np.empty((nvictims, 10))
+        results[:, :4] = params
+        results[:, 4:8] = np.sqrt(np.diagonal(covar, axis1=1, axis2=2))
+        results[:, 8] = chisq
+        results[:, 9] = dof
+
+        return results
+
+    @staticmethod
+    def _solve(normals, rhs):
+        """Solve a stack of equilibrated normal equations."""
+
+        scale = 1./np.sqrt(np.diagonal(normals, axis1=1, axis2=2))
+        outer = scale[:, :, np.newaxis]*scale[:, np.newaxis, :]
+        normals_inv = np.linalg.inv(normals*outer)*outer
+        params = np.einsum('vij,vj->vi', normals_inv, rhs)
+
+        return params, normals_inv
+
+_default_engine = CrosstalkFitEngine()
 
 class CrosstalkMatrix():
 
@@ -207,6 +509,18 @@ class CrosstalkMatrix():
 
         return cls(aggressor_id, signal=signal, matrix=matrix, victim_id=victim_id, namps=16)
 
+    @classmethod
+    def from_summary(cls, aggressor_id, summary, victim_id=None):
+        """Initialize CrosstalkMatrix from a `query_matrix` summary."""
+
+        namps = summary['coefficient'].shape[0]
+        matrix = np.full((10, namps, namps), np.nan)
+        matrix[0, :, :] = summary['coefficient']
+        matrix[4, :, :] = summary['error']
+        signal = np.nanmedian(summary['signal'])
+
+        return cls(aggressor_id, signal=signal, matrix=matrix, victim_id=victim_id, namps=namps)
+
     @property
     def matrix(self):
         return self._matrix
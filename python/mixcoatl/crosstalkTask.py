@@ -8,10 +8,11 @@ TODO:
 import numpy as np
 from astropy.io import fits
 from scipy.ndimage.filters import gaussian_filter
-from sqlalchemy.orm.exc import NoResultFound
 import logging
 from datetime import datetime
+from contextlib import contextmanager
 import os
+from concurrent.futures import ProcessPoolExecutor
 from skimage import feature
 from skimage.transform import hough_line, hough_line_peaks
 
@@ -21,9 +22,101 @@ import lsst.eotest.image_utils as imutils
 from lsst.eotest.sensor.MaskedCCD import MaskedCCD
 from lsst.eotest.sensor.BrightPixels import BrightPixels
 
-from mixcoatl.crosstalk import CrosstalkMatrix, rectangular_mask, satellite_mask, crosstalk_fit
-from mixcoatl.utils import AMP2SEG, calculate_read_noise
-from mixcoatl.database import Sensor, Segment, Result, db_session
+from mixcoatl.crosstalk import CrosstalkMatrix, rectangular_mask, satellite_mask, crosstalk_fit, crosstalk_fit_many
+from mixcoatl.utils import AMP2SEG, AmpImageCache, SharedAmpImages, calculate_read_noise, streaming_amp_stack
+from mixcoatl.database import input_provenance, is_processed, shard_database_path
+from mixcoatl.ingest import open_result_writer
+
+PROVENANCE_IGNORE = ('database', 'verbose', 'cache_size', 'num_workers', 'commit_batch_size',
+                     'sqlite_pragmas', 'spool_dir', 'use_shards', 'skip_processed', 'content_hash')
+"""tuple: Configuration fields that do not change crosstalk results."""
+
+_worker_amp_images = None
+
+def _init_worker(spec):
+    """Attach worker process to shared amplifier images."""
+    global _worker_amp_images
+    _worker_amp_images = SharedAmpImages.attach(spec)
+
+def _run_worker(func, *args):
+    """Call aggressor row function using shared amplifier images."""
+    return func(_worker_amp_images, *args)
+
+@contextmanager
+def aggressor_mapper(amp_images, amps, num_workers=1):
+    """Define a context manager for applying aggressor functions to jobs.
+
+    The context manager yields a function, called as ``mapper(func, jobs)``,
+    that returns the results of ``func(amp_images, *args)`` for the 
+    arguments of each job, in order.  If more than one worker is requested,
+    the jobs are distributed to a process pool and the amplifier images are
+    shared with the worker processes through shared memory.
+
+    Parameters
+    ----------
+    amp_images : mapping
+        Stacked amplifier pixel arrays, indexed by amplifier number.
+    amps : `list`
+        Amplifier numbers.
+    num_workers : `int`
+        Number of worker processes.
+    """
+    if num_workers <= 1:
+        yield lambda func, jobs: [func(amp_images, *args) for args in jobs]
+        return
+
+    with SharedAmpImages.from_images(amp_images, amps) as shared:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, 
+                                 initargs=(shared.spec,)) as executor:
+
+            def mapper(func, jobs):
+                futures = [executor.submit(_run_worker, func, *args) for args in jobs]
+                return [future.result() for future in futures]
+
+            yield mapper
+
+def spot_aggressor_region(amp_images, i, length, threshold):
+    """Find aggressor spot region and signal, if above threshold."""
+
+    aggressor_imarr = amp_images[i]
+
+    smoothed = gaussian_filter(aggressor_imarr, 20)
+    y, x = np.unravel_index(smoothed.argmax(), smoothed.shape)
+    signal = np.max(smoothed)
+    if signal < threshold:
+        return None
+    mask = rectangular_mask(aggressor_imarr, y, x, ly=length, lx=length, region=True)
+
+    return signal, mask
+
+def satellite_aggressor_region(amp_images, i, width, canny_sigma, low_threshold, high_threshold):
+    """Find aggressor streak region and signal, if a streak is detected."""
+
+    aggressor_imarr = amp_images[i]
+
+    tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 1000)
+    edges = feature.canny(aggressor_imarr, sigma=canny_sigma, low_threshold=low_threshold, 
+                          high_threshold=high_threshold)
+    h, theta, d = hough_line(edges, theta=tested_angles)
+    _, angle, dist = hough_line_peaks(h, theta, d)
+
+    if len(angle) != 2:
+        return None
+
+    mean_angle = np.mean(angle)
+    mean_dist = np.mean(dist)
+    mask = satellite_mask(aggressor_imarr, mean_angle, mean_dist, width=width, region=True)
+    bbox, box_mask = mask
+    signal = np.max(aggressor_imarr[bbox][~box_mask])
+
+    return signal, mask
+
+def fit_aggressor_row(amp_images, i, vic_amps, mask, read_noise):
+    """Calculate crosstalk for victim amplifiers from an aggressor region."""
+
+    victim_imarrs = [amp_images[j] for j in vic_amps]
+
+    return crosstalk_fit_many(amp_images[i], victim_imarrs, mask, noise=read_noise)
 
 class InterCCDCrosstalkConfig(pexConfig.Config):
     
@@ -111,22 +204,65 @@ class InterCCDCrosstalkTask(pipeBase.Task):
             crosstalk_matrix.set_diagonal(0.)
         crosstalk_matrix.write_fits(outfile, overwrite=True)
 
-class CrosstalkSpotConfig(pexConfig.Config):
-    
-    database = pexConfig.Field("SQL database DB file", str, default='test.db')
-    length = pexConfig.Field("Length of postage stamps in y and x direction", int, default=200)
-    threshold = pexConfig.Field("Aggressor spot mean signal threshold", float, default=50000.)
-    verbose = pexConfig.Field("Turn verbosity on", bool, default=True)
-
-class CrosstalkSpotTask(pipeBase.Task):
-
-    ConfigClass = CrosstalkSpotConfig
-    _DefaultName = "CrosstalkSpotTask"
+class CrosstalkTaskConfig(pexConfig.Config):
+    """Configuration common to crosstalk tasks."""
+
+    cache_size = pexConfig.Field("Memory budget (MB) for cached amplifier images", float, default=1024.)
+    num_workers = pexConfig.Field("Number of worker processes for aggressor amplifiers", int, default=1)
+    streaming = pexConfig.Field("Coadd exposures one at a time with bounded memory", bool, default=False)
+    stack_statistic = pexConfig.Field("Coadd statistic for streaming mode (mean or median)", str, 
+                                      default='median')
+    chunk_size = pexConfig.Field("Number of exposures per streaming median chunk", int, default=9)
+    commit_batch_size = pexConfig.Field("Number of results per database insert or spool file "
+                                        "(results of a run are committed together)", int, 
+                                        default=10000)
+    sqlite_pragmas = pexConfig.Field("Apply SQLite performance pragmas to database", bool, default=False)
+    spool_dir = pexConfig.Field("Spool directory for single-writer ingestion", str, default=None, 
+                                optional=True)
+    use_shards = pexConfig.Field("Write results to a per-job shard of database", bool, default=False)
+    skip_processed = pexConfig.Field("Skip input files already in provenance table", bool, default=True)
+    content_hash = pexConfig.Field("Hash input file contents, not sizes and mtimes", bool, default=False)
+
+class CrosstalkTask(pipeBase.Task):
+    """Base task for crosstalk measurement from aggressor regions.
+
+    Subclasses set the image type of the results and implement 
+    `find_aggressors`.  The task stacks the amplifier images, finds the 
+    aggressor regions, fits the crosstalk for each victim amplifier and 
+    writes the results to the database.
+    """
+
+    ConfigClass = CrosstalkTaskConfig
+    _DefaultName = "CrosstalkTask"
+    image_type = None
+
+    def find_aggressors(self, mapper, amp_images, ccds, all_amps):
+        """Find aggressor regions.
+
+        Parameters
+        ----------
+        mapper : callable
+            Aggressor function mapper (see `aggressor_mapper`).
+        amp_images : mapping
+            Stacked amplifier pixel arrays, indexed by amplifier number.
+        ccds : `list`
+            `MaskedCCD` for the input files.
+        all_amps : `list`
+            Amplifier numbers.
+
+        Returns
+        -------
+        aggressors : `list` of `tuple`
+            Aggressor amplifier, victim amplifiers, signal and region 
+            descriptor for each aggressor found.
+        """
+        raise NotImplementedError
 
     def run(self, sensor_name, infiles, bias_frame=None, dark_frame=None, linearity_correction=None):
 
         if not isinstance(infiles, list):
             infiles = [infiles]
+        analysis = self._DefaultName
 
         ## Get sensor information from header
         all_amps = imutils.allAmps(infiles[0])
@@ -137,68 +273,94 @@ class CrosstalkSpotTask(pipeBase.Task):
 
         ## Interface with SQL database
         database = self.config.database
-        logging.info("{0}  Running CrosstalkSpotTask using database {1}".format(datetime.now(), database))
-        with db_session(database) as session:
-
-            ## Get sensor from database
-            try:
-                sensor = Sensor.from_db(session, sensor_name=sensor_name)
-            except NoResultFound:
-                sensor = Sensor(sensor_name=sensor_name, lsst_num=lsst_num, manufacturer=manufacturer, 
-                                namps=len(all_amps))
-                sensor.segments = {i : Segment(segment_name=AMP2SEG[i], amplifier_number=i) for i in all_amps}
-                sensor.add_to_db(session)
-                session.commit()
-                logging.info("{0}  New sensor {1} added to database".format(datetime.now(), sensor_name))
-
-            ## Set configuration and analysis settings
-            length = self.config.length
-            threshold = self.config.threshold
-            if len(infiles) > 1:
-                is_coadd = True
+        if self.config.use_shards:
+            database = shard_database_path(database)
+
+        ## Skip input files already processed
+        calib_files = [f for f in (bias_frame, dark_frame) if f is not None]
+        provenance = input_provenance(analysis, sensor_name, infiles + calib_files,
+                                      self.config.toDict(), ignore=PROVENANCE_IGNORE,
+                                      content_hash=self.config.content_hash)
+        if self.config.skip_processed and is_processed(self.config.database, provenance):
+            logging.info("{0}  Input files already processed, skipping.".format(datetime.now()))
+            return
+
+        logging.info("{0}  Running {1} using database {2}".format(datetime.now(), analysis, database))
+        if len(infiles) > 1:
+            is_coadd = True
+        else:
+            is_coadd = False
+        segments = {i : AMP2SEG[i] for i in all_amps}
+        with open_result_writer(database, sensor_name, lsst_num, manufacturer, segments,
+                                spool_dir=self.config.spool_dir, pragmas=self.config.sqlite_pragmas,
+                                batch_size=self.config.commit_batch_size, methodology='MODEL_LSQ',
+                                teststand=teststand, image_type=self.image_type, analysis=analysis,
+                                is_coadd=is_coadd, provenance=provenance) as writer:
+
+            ## Stack amplifier images
+            if self.config.streaming:
+                ccds = [MaskedCCD(infiles[0], bias_frame=bias_frame, dark_frame=dark_frame,
+                                  linearity_correction=linearity_correction)]
+                amp_images = streaming_amp_stack(infiles, all_amps, bias_frame=bias_frame, 
+                                                 dark_frame=dark_frame,
+                                                 linearity_correction=linearity_correction,
+                                                 statistic=self.config.stack_statistic,
+                                                 chunk_size=self.config.chunk_size,
+                                                 num_workers=self.config.num_workers)
             else:
-                is_coadd = False
-            ccds = [MaskedCCD(infile, bias_frame=bias_frame, dark_frame=dark_frame,
-                              linearity_correction=linearity_correction) for infile in infiles]
+                ccds = [MaskedCCD(infile, bias_frame=bias_frame, dark_frame=dark_frame,
+                                  linearity_correction=linearity_correction) for infile in infiles]
+                amp_images = AmpImageCache(infiles, ccds, max_size=self.config.cache_size)
 
             logging.info("{0}  ".format(datetime.now()) + \
                          "Processing files: {}".format(' '.join(map(str, infiles))))
 
-            ## Aggressor amplifiers
-            for i in all_amps:
+            with aggressor_mapper(amp_images, all_amps, num_workers=self.config.num_workers) as mapper:
 
-                aggressor_images = [ccd.unbiased_and_trimmed_image(i).getImage() for ccd in ccds]
-                aggressor_imarr = imutils.stack(aggressor_images).getArray()
+                ## Aggressor amplifiers
+                aggressors = self.find_aggressors(mapper, amp_images, ccds, all_amps)
 
-                ## Find aggressor regions
-                smoothed = gaussian_filter(aggressor_imarr, 20)
-                y, x = np.unravel_index(smoothed.argmax(), smoothed.shape)
-                mask = rectangular_mask(aggressor_imarr, y, x, ly=length, lx=length)
-                signal = np.max(smoothed)
-                if signal < self.config.threshold:
-                    continue
-                
-                read_noise = calculate_read_noise(ccds[0], i)*np.sqrt(2./len(ccds))
-    
-                ## Victim amplifiers
-                for j in all_amps:
-                    
-                    victim_images = [ccd.unbiased_and_trimmed_image(j).getImage() for ccd in ccds]
-                    victim_imarr = imutils.stack(victim_images).getArray()
-
-                    ## Add crosstalk result to database
-                    res = crosstalk_fit(aggressor_imarr, victim_imarr, mask, noise=read_noise)
-                    result = Result(aggressor_id=sensor.segments[i].id, victim_id=sensor.segments[j].id,
-                                    aggressor_signal=signal, coefficient=res[0], error=res[4],
-                                    methodology='MODEL_LSQ', teststand=teststand, image_type='spot',
-                                    analysis='CrosstalkSpotTask', is_coadd=is_coadd)
-                    result.add_to_db(session)
-                    logging.info("{0} Injested C({1},{2}) for signal {3:.1f}".format(datetime.now(), i, j,
-                                                                                     signal))
+                ## Victim amplifiers, with read noise of aggressors found
+                jobs = [(i, vic_amps, mask, calculate_read_noise(ccds[0], i)*np.sqrt(2./len(infiles))) 
+                        for i, vic_amps, signal, mask in aggressors]
+                rows = mapper(fit_aggressor_row, jobs)
+
+            for (i, vic_amps, signal, mask), row_results in zip(aggressors, rows):
+
+                ## Add crosstalk results to database
+                writer.add_row(i, vic_amps, signal, row_results[:, 0], row_results[:, 4])
+                logging.info("{0}  Injested {1} results for aggressor {2} with signal {3:.1f}".format(datetime.now(),
+                                                                                                   len(vic_amps),
+                                                                                                   i, signal))
 
             logging.info("{0}  Task completed successfully.".format(datetime.now()))
 
-class CrosstalkColumnConfig(pexConfig.Config):
+class CrosstalkSpotConfig(CrosstalkTaskConfig):
+    
+    database = pexConfig.Field("SQL database DB file", str, default='test.db')
+    length = pexConfig.Field("Length of postage stamps in y and x direction", int, default=200)
+    threshold = pexConfig.Field("Aggressor spot mean signal threshold", float, default=50000.)
+    verbose = pexConfig.Field("Turn verbosity on", bool, default=True)
+
+class CrosstalkSpotTask(CrosstalkTask):
+
+    ConfigClass = CrosstalkSpotConfig
+    _DefaultName = "CrosstalkSpotTask"
+    image_type = 'spot'
+
+    def find_aggressors(self, mapper, amp_images, ccds, all_amps):
+
+        ## Set configuration and analysis settings
+        length = self.config.length
+        threshold = self.config.threshold
+
+        ## Find aggressor regions
+        jobs = [(i, length, threshold) for i in all_amps]
+        regions = mapper(spot_aggressor_region, jobs)
+
+        return [(i, all_amps) + region for i, region in zip(all_amps, regions) if region is not None]
+
+class CrosstalkColumnConfig(CrosstalkTaskConfig):
 
     database = pexConfig.Field("SQL database DB file", str, default='crosstalk.db')
     length_y = pexConfig.Field("Length of postage stamps in y-direction", int, default=200)
@@ -206,90 +368,39 @@ class CrosstalkColumnConfig(pexConfig.Config):
     verbose = pexConfig.Field("Turn verbosity on", bool, default=True)
     threshold = pexConfig.Field("Aggressor column mean signal threshold", float, default=1000.)
 
-class CrosstalkColumnTask(pipeBase.Task):
+class CrosstalkColumnTask(CrosstalkTask):
 
     ConfigClass = CrosstalkColumnConfig
     _DefaultName = "CrosstalkColumnTask"
+    image_type = 'brightcolumn'
 
-    def run(self, sensor_name, infiles, bias_frame=None, dark_frame=None, linearity_correction=None):
-
-        if not isinstance(infiles, list):
-            infiles = [infiles]
+    def find_aggressors(self, mapper, amp_images, ccds, all_amps):
 
-        ## Get sensor information from header
-        all_amps = imutils.allAmps(infiles[0])
-        with fits.open(infiles[0]) as hdulist:
-            lsst_num = hdulist[0].header['LSST_NUM']
-            teststand = hdulist[0].header['TSTAND']
-            manufacturer = lsst_num[:3]
+        ## Set configuration and analysis settings
+        ly = self.config.length_y
+        lx = self.config.length_x
+        threshold = self.config.threshold
 
-        ## Interface with SQL database
-        database = self.config.database
-        logging.info("{0}  Running CrosstalkColumnTask using database {1}".format(datetime.now(), database))
-        with db_session(database) as session:
-
-            ## Get sensor from database
-            try:
-                sensor = Sensor.from_db(session, sensor_name=sensor_name)
-            except NoResultFound:
-                sensor = Sensor(sensor_name=sensor_name, lsst_num=lsst_num, manufacturer=manufacturer,
-                                namps=len(all_amps))
-                sensor.segments = {i : Segment(segment_name=AMP2SEG[i], amplifier_number=i) for i in all_amps}
-                sensor.add_to_db(session)
-                session.commit()
-                logging.info("{0}  New sensor {1} added to database".format(datetime.now(), sensor_name))
-
-            ## Set configuration and analysis settings
-            ly = self.config.length_y
-            lx = self.config.length_x
-            threshold = self.config.threshold
-            if len(infiles) > 1:
-                is_coadd = True
-            else:
-                is_coadd = False
-            ccds = [MaskedCCD(infile, bias_frame=bias_frame, dark_frame=dark_frame,
-                              linearity_correction=linearity_correction) for infile in infiles]
+        aggressors = []
+        for i in all_amps:
 
-            logging.info("{0}  ".format(datetime.now()) + \
-                         "Processing files: {}".format(' '.join(map(str, infiles))))
+            ## Find aggressor regions
+            exptime = 1
+            gain = 1
+            bp = BrightPixels(ccds[0], i, exptime, gain, ethresh=threshold)
+            pixels, columns = bp.find()
+            if len(columns) == 0:
+                continue
+            col = columns[0]
 
-            ## Aggressor amplifiers
-            for i in all_amps:
+            aggressor_imarr = amp_images[i]
+            signal = np.mean(aggressor_imarr[:, col])
+            mask = rectangular_mask(aggressor_imarr, 1000, col, ly=ly, lx=lx, region=True)
+            aggressors.append((i, all_amps, signal, mask))
 
-                ## Find aggressor regions
-                exptime = 1
-                gain = 1
-                bp = BrightPixels(ccds[0], i, exptime, gain, ethresh=threshold)
-                pixels, columns = bp.find()
-                if len(columns) == 0:
-                    continue
-                col = columns[0]
-
-                read_noise = calculate_read_noise(ccds[0], i)*np.sqrt(2./len(ccds))
-
-                aggressor_images = [ccd.unbiased_and_trimmed_image(i).getImage() for ccd in ccds]
-                aggressor_imarr = imutils.stack(aggressor_images).getArray()
-                signal = np.mean(aggressor_imarr[:, col])
-                mask = rectangular_mask(aggressor_imarr, 1000, col, ly=ly, lx=lx)
-                
-                ## Victim amplifiers
-                for j in all_amps:
-
-                    victim_images = [ccd.unbiased_and_trimmed_image(j).getImage() for ccd in ccds]
-                    victim_imarr = imutils.stack(victim_images).getArray()
-                    
-                    ## Add crosstalk result to database
-                    res = crosstalk_fit(aggressor_imarr, victim_imarr, mask, noise=read_noise)
-                    result = Result(aggressor_id=sensor.segments[i].id, victim_id=sensor.segments[j].id,
-                                    aggressor_signal=signal, coefficient=res[0], error=res[4], 
-                                    methodology='MODEL_LSQ', image_type='brightcolumn',
-                                    teststand=teststand, analysis='CrosstalkColumnTask', is_coadd=is_coadd)
-                    result.add_to_db(session)
-                    logging.info("{0}  Injested C({1},{2}) for signal {3:.1f}".format(datetime.now(), i, j,
-                                                                                      signal))
-            logging.info("{0}  Task completed successfully.".format(datetime.now()))
+        return aggressors
 
-class CrosstalkSatelliteConfig(pexConfig.Config):
+class CrosstalkSatelliteConfig(CrosstalkTaskConfig):
 
     database = pexConfig.Field("SQL database DB file", str, default='crosstalk.db')
     width = pexConfig.Field("Single sided width of streak mask", int, default=50)
@@ -300,98 +411,39 @@ class CrosstalkSatelliteConfig(pexConfig.Config):
     restrict_to_side = pexConfig.Field("Restrict crosstalk to segment pairs on a single side", 
                                        bool, default=True)
 
-class CrosstalkSatelliteTask(pipeBase.Task):
+class CrosstalkSatelliteTask(CrosstalkTask):
 
     ConfigClass = CrosstalkSatelliteConfig
     _DefaultName = "CrosstalkSatelliteTask"
+    image_type = 'satellite'
 
-    def run(self, sensor_name, infiles, bias_frame=None, dark_frame=None, linearity_correction=None):
+    def find_aggressors(self, mapper, amp_images, ccds, all_amps):
 
-        if not isinstance(infiles, list):
-            infiles = [infiles]
-        
-        ## Get sensor information from header
-        all_amps = imutils.allAmps(infiles[0])
-        with fits.open(infiles[0]) as hdulist:
-            lsst_num = hdulist[0].header['LSST_NUM']
-            teststand = hdulist[0].header['TSTAND']
-            manufacturer = lsst_num[:3]
+        ## Set configuration and analysis settings
+        width = self.config.width
+        restrict_to_side = self.config.restrict_to_side
+        canny_sigma = self.config.canny_sigma
+        low_threshold = self.config.low_threshold
+        high_threshold = self.config.high_threshold
 
-        ## Interface with SQL database
-        database = self.config.database
-        logging.info("{0}  Running CrosstalkSatelliteTask using database {1}".format(datetime.now(), 
-                                                                                     database))
-        with db_session(database) as session:
-
-            ## Get sensor from database
-            try:
-                sensor = Sensor.from_db(session, sensor_name=sensor_name)
-            except NoResultFound:
-                sensor = Sensor(sensor_name=sensor_name, lsst_num=lsst_num, manufacturer=manufacturer,
-                                namps=len(all_amps))
-                sensor.segments = {i : Segment(segment_name=AMP2SEG[i], amplifier_number=i) for i in all_amps}
-                sensor.add_to_db(session)
-                session.commit()
-                logging.info("{0}  New sensor {1} added to database".format(datetime.now(), sensor_name))
-
-            ## Set configuration and analysis settings
-            width = self.config.width
-            restrict_to_side = self.config.restrict_to_side
-            canny_sigma = self.config.canny_sigma
-            low_threshold = self.config.low_threshold
-            high_threshold = self.config.high_threshold
-            if len(infiles) > 1:
-                is_coadd = True
-            else:
-                is_coadd = False
-            ccds = [MaskedCCD(infile, bias_frame=bias_frame, dark_frame=dark_frame,
-                              linearity_correction=linearity_correction) for infile in infiles]
+        ## Find aggressor regions
+        jobs = [(i, width, canny_sigma, low_threshold, high_threshold) for i in all_amps]
+        regions = mapper(satellite_aggressor_region, jobs)
 
-            logging.info("{0}  ".format(datetime.now()) + \
-                         "Processing files: {}".format(' '.join(map(str, infiles))))
+        aggressors = []
+        for i, region in zip(all_amps, regions):
 
-            ## Aggressor amplifiers
-            for i in all_amps:
+            if region is None:
+                continue
 
-                aggressor_images = [ccd.unbiased_and_trimmed_image(i).getImage() for ccd in ccds]
-                aggressor_imarr = imutils.stack(aggressor_images).getArray()
-
-                ## Find aggressor regions
-                tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 1000)
-                edges = feature.canny(aggressor_imarr, sigma=canny_sigma, low_threshold=low_threshold, 
-                                      high_threshold=high_threshold)
-                h, theta, d = hough_line(edges, theta=tested_angles)
-                _, angle, dist = hough_line_peaks(h, theta, d)
-
-                if len(angle) != 2:
-                    continue
-
-                read_noise = calculate_read_noise(ccds[0], i)*np.sqrt(2./len(ccds))
-                mean_angle = np.mean(angle)
-                mean_dist = np.mean(dist)
-                mask = satellite_mask(aggressor_imarr, mean_angle, mean_dist, width=width)
-                signal = np.max(aggressor_imarr[~mask])
-                
-                ## Victim amplifiers
-                if restrict_to_side:
-                    if i < 9:
-                        vic_amps = range(1, 9)
-                    else:
-                        vic_amps = range(9, 17)
+            ## Victim amplifiers
+            if restrict_to_side:
+                if i < 9:
+                    vic_amps = list(range(1, 9))
                 else:
-                    vic_amps = all_amps
-
-                for j in vic_amps:
-                    victim_images = [ccd.unbiased_and_trimmed_image(j).getImage() for ccd in ccds]
-                    victim_imarr = imutils.stack(victim_images).getArray()
-                    res = crosstalk_fit(aggressor_imarr, victim_imarr, mask, noise=read_noise)
-
-                    ## Add result to database
-                    result = Result(aggressor_id=sensor.segments[i].id, victim_id=sensor.segments[j].id,
-                                    aggressor_signal=signal, coefficient=res[0], error=res[4], 
-                                    methodology='MODEL_LSQ', teststand=teststand, image_type='satellite',
-                                    analysis='CrosstalkSatelliteTask', is_coadd=is_coadd)
-                    result.add_to_db(session)
-                    logging.info("{0}  Injested C({1},{2}) for signal {3:.1f}".format(datetime.now(), i, j,
-                                                                                      signal))
-            logging.info("{0}  Task completed successfully.".format(datetime.now()))
+                    vic_amps = list(range(9, 17))
+            else:
+                vic_amps = all_amps
+            aggressors.append((i, vic_amps) + region)
+
+        return aggressors
@@ -3,9 +3,22 @@
 To Do:
     * Expand methods for database querying and retrieval of objects.
 """
+import os
+import sqlite3
+import itertools
+import hashlib
+import socket
+import logging
+import tempfile
+import zipfile
+from datetime import datetime
+from urllib.request import pathname2url
+import numpy as np
 import sqlalchemy as sql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, sessionmaker, aliased
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from contextlib import contextmanager
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -15,8 +28,120 @@ from mixcoatl.errors import AlreadyExists, MissingKeyword
 Base = declarative_base()
 Session = sessionmaker()
 
+SQLITE_PRAGMAS = {'journal_mode' : 'WAL', 'synchronous' : 'NORMAL',
+                  'cache_size' : -65536, 'mmap_size' : 268435456}
+"""dict: SQLite performance pragmas (WAL journal, 64 MB page cache, 256 MB mmap)."""
+
+SIGNAL_BINS_PER_DECADE = 10
+"""int: Number of logarithmic aggressor signal bins per decade in the summary table."""
+
+_engines = {}
+
+def signal_bin(signal):
+    """Return logarithmic summary table bin of an aggressor signal."""
+    if signal is None:
+        return None
+
+    return int(np.floor(SIGNAL_BINS_PER_DECADE*np.log10(max(signal, 1.))))
+
+def summary_weight(error):
+    """Return inverse-variance weight of a result, or zero for invalid errors."""
+    if error is None or not (np.isfinite(error) and error > 0.):
+        return 0.
+
+    return 1./(error*error)
+
+def get_engine(database, echo=False, pragmas=False):
+    """Return a cached, pooled engine for an SQLite database.
+
+    The engine is created, and the database schema checked, only once per
+    database path within a process.
+    
+    Parameters
+    ----------
+    database : `str` 
+        Filepath to SQLite database.
+    echo : `bool`
+        `True` to enable Engine to log all statements to log handler, which
+        defaults to `sys.stdout`.
+    pragmas : `bool` or `dict`
+        `True` to apply `SQLITE_PRAGMAS` to each new connection, or a 
+        dictionary of pragma names and values.
+    """
+    if pragmas is True:
+        pragmas = SQLITE_PRAGMAS
+    pragmas = dict(pragmas) if pragmas else {}
+
+    key = (os.path.abspath(database), echo, tuple(sorted(pragmas.items())))
+    try:
+        return _engines[key]
+    except KeyError:
+        pass
+
+    engine = sql.create_engine('sqlite:///{0}'.format(database), echo=echo, poolclass=QueuePool,
+                               connect_args={'check_same_thread' : False})
+
+    @sql.event.listens_for(engine, 'connect')
+    def create_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('signal_bin', 1, signal_bin, deterministic=True)
+        dbapi_connection.create_function('summary_weight', 1, summary_weight, deterministic=True)
+
+    if pragmas:
+        @sql.event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {0}={1}'.format(name, value))
+            cursor.close()
+
+    table_names = sql.inspect(engine).get_table_names()
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
+    if 'result' in table_names and 'result_summary' not in table_names:
+        rebuild_summary(engine)
+    _engines[key] = engine
+
+    return engine
+
+def upgrade_schema(engine):
+    """Add missing indexes to the tables of an existing database.
+
+    `Base.metadata.create_all` only creates indexes for new tables, so
+    indexes added to the schema are created here for database files made
+    with an earlier schema.
+
+    Parameters
+    ----------
+    engine : `sqlalchemy.engine.Engine`
+        Database engine.
+    """
+    inspector = sql.inspect(engine)
+    table_names = inspector.get_table_names()
+
+    created = False
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                created = True
+
+    ## Update query planner statistics for new indexes
+    if created:
+        with engine.begin() as connection:
+            connection.execute(sql.text('ANALYZE'))
+
+def dispose_engines():
+    """Close all pooled connections and clear the engine cache."""
+
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
+
 @contextmanager
-def db_session(database, echo=False):
+def db_session(database, echo=False, pragmas=False):
     """Define a context manager for a database session.
     
     Parameters
@@ -26,11 +151,12 @@ def db_session(database, echo=False):
     echo : `bool`
         `True` to enable Engine to log all statements to log handler, which
         defaults to `sys.stdout`.
+    pragmas : `bool` or `dict`
+        `True` to apply `SQLITE_PRAGMAS` to each new connection, or a 
+        dictionary of pragma names and values.
     """
-    engine = sql.create_engine('sqlite:///{0}'.format(database), echo=echo)
-    Base.metadata.create_all(engine)
-    Session.configure(bind=engine)
-    session = Session()
+    engine = get_engine(database, echo=echo, pragmas=pragmas)
+    session = Session(bind=engine)
 
     try:
         yield session
@@ -60,6 +186,12 @@ class Result(Base):
     analysis = sql.Column(sql.String, comment='Analysis task (e.g. CrosstalkSatelliteTask).')
     is_coadd = sql.Column(sql.Boolean, comment='Indicator for coadded image.')
 
+    ## Indexes
+    __table_args__ = (sql.Index('ix_result_aggressor_victim', 'aggressor_id', 'victim_id'),
+                      sql.Index('ix_result_victim', 'victim_id'),
+                      sql.Index('ix_result_filters', 'methodology', 'image_type', 'analysis', 
+                                'teststand', 'is_coadd'))
+
     ## Relationships
     aggressor = relationship("Segment", back_populates="results", foreign_keys=[aggressor_id])
     victim = relationship("Segment", foreign_keys=[victim_id])
@@ -72,6 +204,189 @@ class Result(Base):
         """Add Result to database."""
         session.add(self)
         
+class ResultSummary(Base):
+
+    __tablename__ = 'result_summary'
+
+    ## Columns
+    id = sql.Column(sql.Integer, primary_key=True)
+    aggressor_id = sql.Column(sql.Integer, sql.ForeignKey('segment.id'), 
+                              comment='ID for aggressor segment.')
+    victim_id = sql.Column(sql.Integer, sql.ForeignKey('segment.id'), 
+                           comment='ID for victim segment.')
+    methodology = sql.Column(sql.String, nullable=False, default='', server_default='',
+                             comment='Measurement methodology (empty if unknown).')
+    image_type = sql.Column(sql.String, nullable=False, default='', server_default='',
+                            comment='Type of image (e.g. satellite), empty if unknown.')
+    signal_bin = sql.Column(sql.Integer, comment='Logarithmic aggressor signal bin.')
+    count = sql.Column(sql.Integer, comment='Number of results.')
+    sum_signal = sql.Column(sql.Float, comment='Sum of aggressor signals.')
+    sum_weight = sql.Column(sql.Float, comment='Sum of inverse-variance weights.')
+    sum_weighted_coefficient = sql.Column(sql.Float, comment='Sum of weighted crosstalk coefficients.')
+    sum_coefficient = sql.Column(sql.Float, comment='Sum of crosstalk coefficients.')
+    sum_coefficient2 = sql.Column(sql.Float, comment='Sum of squared crosstalk coefficients.')
+
+    ## Indexes
+    __table_args__ = (sql.Index('ix_result_summary_key', 'aggressor_id', 'victim_id', 'methodology',
+                                'image_type', 'signal_bin', unique=True),)
+
+    def __repr__(self):
+        return "<ResultSummary(signal_bin={0:d}, count={1:d}, methodology='{2}')>".\
+            format(self.signal_bin, self.count, self.methodology)
+
+SUMMARY_KEY = ['aggressor_id', 'victim_id', 'methodology', 'image_type', 'signal_bin']
+SUMMARY_SUMS = ['count', 'sum_signal', 'sum_weight', 'sum_weighted_coefficient', 'sum_coefficient',
+                'sum_coefficient2']
+
+def _summary_upsert(target, source, aggressor_id='r.aggressor_id', victim_id='r.victim_id'):
+    """Return SQL to add results from a source (aliased as r) to a summary table.
+
+    Results with non-finite coefficients (stored as NULL or infinity) are
+    left out of the summary.
+    """
+    return ('INSERT INTO {0} ({1}) '
+            "SELECT {2}, {3}, COALESCE(r.methodology, ''), COALESCE(r.image_type, ''), "
+            'signal_bin(r.aggressor_signal), COUNT(*), '
+            'SUM(r.aggressor_signal), SUM(summary_weight(r.error)), '
+            'SUM(summary_weight(r.error)*r.coefficient), SUM(r.coefficient), '
+            'SUM(r.coefficient*r.coefficient) '
+            'FROM {4} WHERE r.coefficient > -9e999 AND r.coefficient < 9e999 GROUP BY 1, 2, 3, 4, 5 '
+            'ON CONFLICT ({5}) DO UPDATE SET {6}').format(
+                target, ', '.join(SUMMARY_KEY + SUMMARY_SUMS), aggressor_id, victim_id, source,
+                ', '.join(SUMMARY_KEY), 
+                ', '.join('{0} = {0} + excluded.{0}'.format(name) for name in SUMMARY_SUMS))
+
+def rebuild_summary(engine):
+    """Recompute the result summary table from all results.
+
+    Parameters
+    ----------
+    engine : `sqlalchemy.engine.Engine`
+        Database engine (see `get_engine`).
+    """
+    with engine.begin() as connection:
+        connection.execute(ResultSummary.__table__.delete())
+        connection.execute(sql.text(_summary_upsert('result_summary', 'result AS r')))
+
+def summarize_rows(rows):
+    """Aggregate result rows for the result summary table.
+
+    Rows with non-finite coefficients are left out, so they do not bias the
+    weighted mean coefficients.  Missing methodology and image type are
+    summarized as empty strings, since NULL values never conflict in the 
+    unique summary key.
+
+    Parameters
+    ----------
+    rows : `list`
+        Result column values, as dictionaries.
+
+    Returns
+    -------
+    summary_rows : `list`
+        Summary column values, as dictionaries.
+    """
+    summary = {}
+    for row in rows:
+        coefficient = row['coefficient']
+        if coefficient is None or not np.isfinite(coefficient):
+            continue
+        key = (row['aggressor_id'], row['victim_id'], row.get('methodology') or '', 
+               row.get('image_type') or '', signal_bin(row['aggressor_signal']))
+        weight = summary_weight(row['error'])
+        sums = summary.setdefault(key, [0, 0., 0., 0., 0., 0.])
+        sums[0] += 1
+        sums[1] += row['aggressor_signal']
+        sums[2] += weight
+        sums[3] += weight*coefficient
+        sums[4] += coefficient
+        sums[5] += coefficient*coefficient
+
+    return [dict(zip(SUMMARY_KEY + SUMMARY_SUMS, key + tuple(sums))) for key, sums in summary.items()]
+
+class ResultWriter():
+    """Bulk writer for crosstalk results.
+
+    Results are gathered for each aggressor amplifier as arrays and inserted
+    into the result table using a single executemany statement per batch,
+    bypassing the creation of ORM `Result` objects, and the result summary
+    table is updated for each batch.  The session is committed after each 
+    batch if ``commit`` is `True`.
+
+    Parameters
+    ----------
+    session : `sqlalchemy.orm.Session`
+        Database session.
+    sensor : `Sensor`
+        Sensor with segments in the database.
+    batch_size : `int`
+        Number of results to gather before each insert and commit.
+    commit : `bool`
+        `True` to commit the session after each batch.
+    **columns
+        Column values common to all results (e.g. methodology, image_type,
+        teststand, analysis, is_coadd).
+    """
+
+    def __init__(self, session, sensor, batch_size=10000, commit=True, **columns):
+
+        self.session = session
+        self.sensor = sensor
+        self.batch_size = batch_size
+        self.commit = commit
+        self.columns = columns
+        self.nrows = 0
+        self._rows = []
+
+    def add_row(self, aggressor_amp, victim_amps, signal, coefficients, errors):
+        """Add crosstalk results for a single aggressor amplifier.
+
+        Parameters
+        ----------
+        aggressor_amp : `int`
+            Aggressor amplifier number.
+        victim_amps : `list`
+            Victim amplifier numbers.
+        signal : `float`
+            Pixel signal of aggressor.
+        coefficients : array-like
+            Crosstalk coefficient for each victim amplifier.
+        errors : array-like
+            Error estimate of crosstalk coefficient for each victim amplifier.
+        """
+        segments = self.sensor.segments
+        aggressor_id = segments[aggressor_amp].id
+        for victim_amp, coefficient, error in zip(victim_amps, coefficients, errors):
+            row = {'aggressor_id' : aggressor_id, 'victim_id' : segments[victim_amp].id,
+                   'aggressor_signal' : float(signal), 'coefficient' : float(coefficient),
+                   'error' : float(error)}
+            row.update(self.columns)
+            self._rows.append(row)
+
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert gathered results into database."""
+
+        if len(self._rows) == 0:
+            return
+        self.session.execute(Result.__table__.insert(), self._rows)
+
+        ## Update result summary table
+        table = ResultSummary.__table__
+        upsert = sqlite_insert(table)
+        upsert = upsert.on_conflict_do_update(index_elements=SUMMARY_KEY,
+                                              set_={name : table.c[name] + upsert.excluded[name] 
+                                                    for name in SUMMARY_SUMS})
+        summary_rows = summarize_rows(self._rows)
+        if len(summary_rows) > 0:
+            self.session.execute(upsert, summary_rows)
+        self.nrows += len(self._rows)
+        self._rows = []
+        if self.commit:
+            self.session.commit()
+
 class Segment(Base):
     
     __tablename__ = 'segment'
@@ -81,6 +396,9 @@ class Segment(Base):
     segment_name = sql.Column(sql.String, comment='Segment name (e.g. C00).')
     amplifier_number = sql.Column(sql.Integer, comment='Segment amplifier number.')
     sensor_id = sql.Column(sql.Integer, sql.ForeignKey('sensor.id'), comment='ID for CCD sensor.')
+
+    ## Indexes
+    __table_args__ = (sql.Index('ix_segment_sensor_amplifier', 'sensor_id', 'amplifier_number'),)
     
     ## Relationships
     results = relationship("Result", back_populates="aggressor", cascade="all, delete-orphan",
@@ -128,6 +446,10 @@ class Sensor(Base):
     lsst_num = sql.Column(sql.String, comment='LSST project number.')
     manufacturer = sql.Column(sql.String, comment='Manufacturer (E2V or ITL).')
     namps = sql.Column(sql.Integer, comment='Number of amplifiers.')
+
+    ## Indexes
+    __table_args__ = (sql.Index('ix_sensor_sensor_name', 'sensor_name'),
+                      sql.Index('ix_sensor_lsst_num', 'lsst_num'))
     
     ## Relationships
     segments = relationship("Segment", collection_class=attribute_mapped_collection('amplifier_number'), 
@@ -157,6 +479,178 @@ class Sensor(Base):
         """Add Sensor to database."""
         session.add(self)
 
+class Provenance(Base):
+
+    __tablename__ = 'provenance'
+
+    ## Columns
+    id = sql.Column(sql.Integer, primary_key=True)
+    analysis = sql.Column(sql.String, comment='Analysis task (e.g. CrosstalkSatelliteTask).')
+    sensor_name = sql.Column(sql.String, comment='Sensor name (e.g. R22/S22).')
+    filepath = sql.Column(sql.String, comment='Input file paths, newline separated.')
+    file_hash = sql.Column(sql.String, comment='Hash of input file contents or sizes and mtimes.')
+    config_hash = sql.Column(sql.String, comment='Hash of analysis task configuration.')
+    nresults = sql.Column(sql.Integer, comment='Number of results ingested.')
+    timestamp = sql.Column(sql.DateTime, default=datetime.now, comment='Time of ingestion.')
+
+    ## Indexes
+    __table_args__ = (sql.Index('ix_provenance_lookup', 'analysis', 'sensor_name', 'file_hash', 
+                                'config_hash'),)
+
+    def __repr__(self):
+        return "<Provenance(analysis='{0}', sensor_name='{1}', nresults={2})>".format(self.analysis,
+                                                                                     self.sensor_name,
+                                                                                     self.nresults)
+
+    @classmethod
+    def is_processed(cls, session, analysis, sensor_name, file_hash, config_hash, **kwargs):
+        """Check if input files were already processed with a configuration."""
+        query = session.query(cls.id).filter(cls.analysis == analysis, 
+                                             cls.sensor_name == sensor_name,
+                                             cls.file_hash == file_hash, 
+                                             cls.config_hash == config_hash)
+
+        return query.first() is not None
+
+    def add_to_db(self, session):
+        """Add Provenance to database."""
+        session.add(self)
+
+def get_or_create_sensor(session, sensor_name, lsst_num, manufacturer, segments):
+    """Get sensor from database, adding it with its segments if not found.
+
+    A new sensor is flushed rather than committed, so it is committed in 
+    the same transaction as the caller's results.
+
+    Parameters
+    ----------
+    session : `sqlalchemy.orm.Session`
+        Database session.
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    lsst_num : `str`
+        LSST project number.
+    manufacturer : `str`
+        Manufacturer (E2V or ITL).
+    segments : `dict`
+        Segment names, keyed by amplifier number.
+
+    Returns
+    -------
+    sensor : `Sensor`
+        Sensor with segments in the database.
+    """
+    try:
+        sensor = Sensor.from_db(session, sensor_name=sensor_name)
+    except NoResultFound:
+        sensor = Sensor(sensor_name=sensor_name, lsst_num=lsst_num, manufacturer=manufacturer, 
+                        namps=len(segments))
+        sensor.segments = {int(i) : Segment(segment_name=segment_name, amplifier_number=int(i)) 
+                           for i, segment_name in segments.items()}
+        sensor.add_to_db(session)
+        session.flush()
+        logging.info("{0}  New sensor {1} added to database".format(datetime.now(), sensor_name))
+
+    return sensor
+
+def input_provenance(analysis, sensor_name, infiles, config, ignore=(), content_hash=False):
+    """Describe the input files and configuration of an analysis task run.
+
+    Parameters
+    ----------
+    analysis : `str`
+        Analysis task (e.g. CrosstalkSatelliteTask).
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    infiles : `list`
+        Input file paths.
+    config : `dict`
+        Analysis task configuration.
+    ignore : `list`
+        Configuration fields that do not change results (e.g. database).
+    content_hash : `bool`
+        `True` to hash input file contents, rather than sizes and 
+        modification times.
+
+    Returns
+    -------
+    provenance : `dict`
+        Provenance column values (analysis, sensor_name, filepath, file_hash,
+        config_hash).
+    """
+    filepaths = sorted(os.path.abspath(infile) for infile in infiles)
+
+    file_hash = hashlib.sha1()
+    for filepath in filepaths:
+        file_hash.update(filepath.encode())
+        if content_hash:
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    file_hash.update(block)
+        else:
+            stat = os.stat(filepath)
+            file_hash.update('{0:d} {1:d}'.format(stat.st_size, stat.st_mtime_ns).encode())
+
+    config_items = sorted((key, value) for key, value in config.items() if key not in ignore)
+    config_hash = hashlib.sha1(repr(config_items).encode())
+
+    return {'analysis' : analysis, 'sensor_name' : sensor_name, 'filepath' : '\n'.join(filepaths),
+            'file_hash' : file_hash.hexdigest(), 'config_hash' : config_hash.hexdigest()}
+
+def is_processed(database, provenance):
+    """Check if a task run is in the provenance table, read-only.
+
+    The database is opened read-only and without the table and index setup
+    of `get_engine`, so many task processes writing to a spool directory 
+    or to shards can check the main database without taking its write 
+    lock.  A missing database file or provenance table counts as not 
+    processed.
+
+    Parameters
+    ----------
+    database : `str`
+        Filepath to SQLite database.
+    provenance : `dict`
+        Provenance column values for the task run (see `input_provenance`).
+
+    Returns
+    -------
+    processed : `bool`
+        `True` if the input files were already processed with the 
+        configuration.
+    """
+    if not os.path.exists(database):
+        return False
+
+    uri = 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(database)))
+    engine = sql.create_engine('sqlite://', creator=lambda: sqlite3.connect(uri, uri=True))
+    try:
+        if not sql.inspect(engine).has_table(Provenance.__tablename__):
+            return False
+        session = Session(bind=engine)
+        try:
+            return Provenance.is_processed(session, **provenance)
+        finally:
+            session.close()
+    finally:
+        engine.dispose()
+
+def filter_results(query, **kwargs):
+    """Filter a query on the result table by column values."""
+
+    if 'methodology' in kwargs:
+        query = query.filter(Result.methodology == kwargs['methodology'])
+    if 'image_type' in kwargs:
+        query = query.filter(Result.image_type == kwargs['image_type'])
+    if 'teststand' in kwargs:
+        query = query.filter(Result.teststand == kwargs['teststand'])
+    if 'analysis' in kwargs:
+        query = query.filter(Result.analysis == kwargs['analysis'])
+    if 'is_coadd' in kwargs:
+        query = query.filter(Result.is_coadd == kwargs['is_coadd'])
+
+    return query
+
 def query_results(session, sensor_name, aggressor_amp, victim_amp, **kwargs):
     """Query database for results."""
     a1 = aliased(Segment)
@@ -169,15 +663,446 @@ def query_results(session, sensor_name, aggressor_amp, victim_amp, **kwargs):
         join(Sensor).filter(Sensor.sensor_name == sensor_name)
 
     ## Filter results by columns 
+    query = filter_results(query, **kwargs)
+
+    return query.all()
+
+def query_matrix(session, sensor_name, summary=False, **kwargs):
+    """Query database for results of all amplifier pairs of a sensor.
+
+    All results are retrieved with a single query and returned as arrays
+    indexed by aggressor and victim amplifier number minus one.
+
+    Parameters
+    ----------
+    session : `sqlalchemy.orm.Session`
+        Database session.
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    summary : `bool`
+        `True` to group results by amplifier pair in the query and return
+        a summary for each pair.
+    **kwargs
+        Result column values to filter on (e.g. methodology, image_type).
+
+    Returns
+    -------
+    matrix : `dict`
+        If ``summary`` is `False`, arrays of 'coefficient', 'error' and 
+        'signal' with shape (namps, namps, nsamples), padded with NaN, 
+        and 'count' with shape (namps, namps).  If ``summary`` is `True`,
+        arrays of the inverse-variance weighted mean 'coefficient', its 
+        'error', the mean 'signal' and 'count' with shape (namps, namps),
+        leaving out results with non-finite coefficients as the result 
+        summary table does.
+    """
+    namps = Sensor.from_db(session, sensor_name=sensor_name).namps
+    a1 = aliased(Segment)
+    a2 = aliased(Segment)
+
+    if summary:
+        weight = 1./(Result.error*Result.error)
+        columns = [a1.amplifier_number, a2.amplifier_number, sql.func.count(Result.id),
+                   sql.func.sum(Result.coefficient*weight), sql.func.sum(weight),
+                   sql.func.avg(Result.aggressor_signal)]
+    else:
+        columns = [a1.amplifier_number, a2.amplifier_number, Result.coefficient, 
+                   Result.error, Result.aggressor_signal]
+
+    query = session.query(*columns).select_from(Result).\
+        join(a1, Result.aggressor_id == a1.id).\
+        join(a2, Result.victim_id == a2.id).\
+        join(Sensor, a1.sensor_id == Sensor.id).\
+        filter(Sensor.sensor_name == sensor_name)
+    query = filter_results(query, **kwargs)
+
+    if summary:
+        ## Exclude non-finite coefficients (stored as NULL or infinity)
+        query = query.filter(Result.coefficient > -np.inf, Result.coefficient < np.inf)
+        query = query.group_by(a1.amplifier_number, a2.amplifier_number)
+    else:
+        query = query.order_by(a1.amplifier_number, a2.amplifier_number, Result.id)
+    rows = np.array(query.all(), dtype=float).reshape(-1, len(columns))
+
+    ## Construct arrays indexed by amplifier pair
+    agg = rows[:, 0].astype(int) - 1
+    vic = rows[:, 1].astype(int) - 1
+    count = np.zeros((namps, namps), dtype=int)
+
+    if summary:
+        count[agg, vic] = rows[:, 2]
+        matrix = {'coefficient' : np.full((namps, namps), np.nan),
+                  'error' : np.full((namps, namps), np.nan),
+                  'signal' : np.full((namps, namps), np.nan),
+                  'count' : count}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix['coefficient'][agg, vic] = rows[:, 3]/rows[:, 4]
+            matrix['error'][agg, vic] = 1./np.sqrt(rows[:, 4])
+        matrix['signal'][agg, vic] = rows[:, 5]
+
+        return matrix
+
+    pairs = agg*namps + vic
+    _, first, pair_counts = np.unique(pairs, return_index=True, return_counts=True)
+    sample = np.arange(pairs.shape[0]) - np.repeat(first, pair_counts)
+    nsamples = pair_counts.max() if pair_counts.shape[0] > 0 else 0
+    np.add.at(count, (agg, vic), 1)
+
+    matrix = {'count' : count}
+    for key, n in [('coefficient', 2), ('error', 3), ('signal', 4)]:
+        matrix[key] = np.full((namps, namps, nsamples), np.nan)
+        matrix[key][agg, vic, sample] = rows[:, n]
+
+    return matrix
+
+def query_summary(session, sensor_name, **kwargs):
+    """Query result summary table for crosstalk versus signal of a sensor.
+
+    Parameters
+    ----------
+    session : `sqlalchemy.orm.Session`
+        Database session.
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    **kwargs
+        Summary column values to filter on (methodology, image_type).
+
+    Returns
+    -------
+    summary : `dict`
+        Arrays of mean signal, inverse-variance weighted mean coefficient
+        and its error for each signal bin, keyed by aggressor and victim 
+        amplifier number.
+    """
+    a1 = aliased(Segment)
+    a2 = aliased(Segment)
+    columns = [a1.amplifier_number, a2.amplifier_number, ResultSummary.signal_bin,
+               sql.func.sum(ResultSummary.count), sql.func.sum(ResultSummary.sum_signal),
+               sql.func.sum(ResultSummary.sum_weight), 
+               sql.func.sum(ResultSummary.sum_weighted_coefficient)]
+
+    query = session.query(*columns).select_from(ResultSummary).\
+        join(a1, ResultSummary.aggressor_id == a1.id).\
+        join(a2, ResultSummary.victim_id == a2.id).\
+        join(Sensor, a1.sensor_id == Sensor.id).\
+        filter(Sensor.sensor_name == sensor_name)
     if 'methodology' in kwargs:
-        query = query.filter(Result.methodology == kwargs['methodology'])
+        query = query.filter(ResultSummary.methodology == kwargs['methodology'])
     if 'image_type' in kwargs:
-        query = query.filter(Result.image_type == kwargs['image_type'])
-    if 'teststand' in kwargs:
-        query = query.filter(Result.teststand == kwargs['teststand'])
-    if 'analysis' in kwargs:
-        query = query.filter(Result.analysis == kwargs['analysis'])
-    if 'is_coadd' in kwargs:
-        query = query.filter(Result.is_coadd == kwargs['is_coadd'])
+        query = query.filter(ResultSummary.image_type == kwargs['image_type'])
+    query = query.group_by(a1.amplifier_number, a2.amplifier_number, ResultSummary.signal_bin).\
+        order_by(a1.amplifier_number, a2.amplifier_number, ResultSummary.signal_bin)
+    rows = np.array(query.all(), dtype=float).reshape(-1, len(columns))
 
-    return query.all()
+    summary = {}
+    pairs = rows[:, :2].astype(int)
+    for agg, vic in np.unique(pairs, axis=0):
+        pair_rows = rows[(pairs[:, 0] == agg) & (pairs[:, 1] == vic)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary[(int(agg), int(vic))] = (pair_rows[:, 4]/pair_rows[:, 3], pair_rows[:, 6]/pair_rows[:, 5],
+                                   1./np.sqrt(pair_rows[:, 5]))
+
+    return summary
+
+EXPORT_COLUMNS = [('id', 'int64'), ('sensor_name', 'category'), ('lsst_num', 'category'), 
+                  ('aggressor_amp', 'int32'), ('victim_amp', 'int32'), ('aggressor_signal', 'float64'),
+                  ('coefficient', 'float64'), ('error', 'float64'), ('methodology', 'category'), 
+                  ('image_type', 'category'), ('teststand', 'category'), ('analysis', 'category'),
+                  ('is_coadd', 'bool')]
+"""list: Column names and types of exported results; category columns are dictionary encoded."""
+
+def export_results(session, outfile, file_format=None, chunk_size=100000, **kwargs):
+    """Export joined crosstalk results to a columnar file.
+
+    Results joined with the aggressor and victim segments and sensor are
+    read in chunks and written to a Parquet, Arrow IPC or NumPy ``.npz`` 
+    file, so memory use is bounded by the chunk size.  String columns are 
+    dictionary encoded; in ``.npz`` files they are stored as integer codes
+    (-1 for null) with a ``<column>_categories`` array.
+
+    Parameters
+    ----------
+    session : `sqlalchemy.orm.Session`
+        Database session.
+    outfile : `str`
+        Output filename.
+    file_format : `str`, optional
+        Output format, one of 'parquet', 'arrow' or 'npz'.  Determined
+        from the file extension if `None`.
+    chunk_size : `int`
+        Number of results to read per chunk.
+    **kwargs
+        Result column values to filter on (e.g. methodology, image_type).
+
+    Returns
+    -------
+    nrows : `int`
+        Number of exported results.
+    """
+    if file_format is None:
+        extension = os.path.splitext(outfile)[1].lower()
+        formats = {'.parquet' : 'parquet', '.pq' : 'parquet', '.arrow' : 'arrow', 
+                   '.feather' : 'arrow', '.ipc' : 'arrow', '.npz' : 'npz'}
+        try:
+            file_format = formats[extension]
+        except KeyError:
+            raise ValueError("Unknown export file extension: {0}".format(extension))
+
+    a1 = aliased(Segment)
+    a2 = aliased(Segment)
+    columns = {'id' : Result.id, 'sensor_name' : Sensor.sensor_name, 'lsst_num' : Sensor.lsst_num,
+               'aggressor_amp' : a1.amplifier_number, 'victim_amp' : a2.amplifier_number,
+               'aggressor_signal' : Result.aggressor_signal, 'coefficient' : Result.coefficient,
+               'error' : Result.error, 'methodology' : Result.methodology, 
+               'image_type' : Result.image_type, 'teststand' : Result.teststand, 
+               'analysis' : Result.analysis, 'is_coadd' : Result.is_coadd}
+    query = session.query(*[columns[name] for name, dtype in EXPORT_COLUMNS]).select_from(Result).\
+        join(a1, Result.aggressor_id == a1.id).\
+        join(a2, Result.victim_id == a2.id).\
+        join(Sensor, a1.sensor_id == Sensor.id)
+    query = filter_results(query, **kwargs)
+    nrows = query.count()
+
+    ## Fixed dictionaries so that every chunk shares the same encoding
+    categories = {}
+    for name, dtype in EXPORT_COLUMNS:
+        if dtype == 'category':
+            values = [value for (value,) in session.query(columns[name]).distinct() if value is not None]
+            categories[name] = sorted(values)
+
+    def chunks():
+        rows = iter(query.order_by(Result.id).yield_per(chunk_size))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if len(chunk) == 0:
+                return
+            yield _encode_chunk(chunk, categories)
+
+    if file_format == 'npz':
+        _write_npz(outfile, chunks(), nrows, categories)
+    elif file_format in ('parquet', 'arrow'):
+        _write_arrow(outfile, chunks(), categories, file_format)
+    else:
+        raise ValueError("Unknown export file format: {0}".format(file_format))
+
+    return nrows
+
+def _encode_chunk(chunk, categories):
+    """Convert a chunk of result rows to encoded column arrays."""
+
+    data = {}
+    for n, (name, dtype) in enumerate(EXPORT_COLUMNS):
+        values = [row[n] for row in chunk]
+        if dtype == 'category':
+            codes = {value : code for code, value in enumerate(categories[name])}
+            data[name] = np.fromiter((codes.get(value, -1) for value in values), dtype=np.int32,
+                                     count=len(values))
+        else:
+            data[name] = np.array(values, dtype=dtype)
+
+    return data
+
+def _write_npz(outfile, chunks, nrows, categories):
+    """Write encoded column chunks to a NumPy .npz file."""
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outfile))) as tmpdir:
+
+        arrays = {}
+        for name, dtype in EXPORT_COLUMNS:
+            array_dtype = np.int32 if dtype == 'category' else np.dtype(dtype)
+            arrays[name] = np.lib.format.open_memmap(os.path.join(tmpdir, '{0}.npy'.format(name)), 
+                                                     mode='w+', dtype=array_dtype, shape=(nrows,))
+        start = 0
+        for data in chunks:
+            n = data['id'].shape[0]
+            for name, array in arrays.items():
+                array[start:start+n] = data[name]
+            start += n
+        for array in arrays.values():
+            array.flush()
+        arrays.clear()
+
+        for name, values in categories.items():
+            np.save(os.path.join(tmpdir, '{0}_categories.npy'.format(name)), np.array(values, dtype=str))
+
+        with zipfile.ZipFile(outfile, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for filename in sorted(os.listdir(tmpdir)):
+                zf.write(os.path.join(tmpdir, filename), arcname=filename)
+
+def _write_arrow(outfile, chunks, categories, file_format):
+    """Write encoded column chunks to a Parquet or Arrow IPC file."""
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is required to export results to Parquet or Arrow files.")
+
+    dictionaries = {name : pa.array(values, type=pa.string()) for name, values in categories.items()}
+    fields = []
+    for name, dtype in EXPORT_COLUMNS:
+        if dtype == 'category':
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(name, pa.from_numpy_dtype(np.dtype(dtype))))
+    schema = pa.schema(fields)
+
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(outfile, schema)
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_file(outfile, schema)
+        write = writer.write_table
+
+    try:
+        for data in chunks:
+            arrays = []
+            for name, dtype in EXPORT_COLUMNS:
+                if dtype == 'category':
+                    codes = pa.array(data[name], mask=data[name] < 0)
+                    arrays.append(pa.DictionaryArray.from_arrays(codes, dictionaries[name]))
+                else:
+                    arrays.append(pa.array(data[name]))
+            write(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        writer.close()
+
+def shard_database_path(database, shard_id=None):
+    """Return the filepath of a per-job shard of an SQLite database.
+
+    Shards are placed in a directory named after the master database
+    (e.g. ``crosstalk_shards/`` for ``crosstalk.db``).
+
+    Parameters
+    ----------
+    database : `str`
+        Filepath to master SQLite database.
+    shard_id : `str`, optional
+        Shard identifier; defaults to the host name and process ID.
+
+    Returns
+    -------
+    shard : `str`
+        Filepath to shard SQLite database.
+    """
+    if shard_id is None:
+        shard_id = '{0}_{1:d}'.format(socket.gethostname(), os.getpid())
+    root, ext = os.path.splitext(database)
+    shard_dir = root + '_shards'
+    os.makedirs(shard_dir, exist_ok=True)
+
+    return os.path.join(shard_dir, '{0}{1}'.format(shard_id, ext or '.db'))
+
+def merge_databases(database, shards, pragmas=False):
+    """Merge shard databases into a master database.
+
+    Sensors are matched by sensor name and LSST number, and segments by
+    sensor and amplifier number; missing sensors and segments are added to
+    the master database.  Results are copied in bulk using ``ATTACH
+    DATABASE`` and ``INSERT ... SELECT``, with segment primary keys remapped
+    to those of the master database.  Each shard is merged in a single
+    transaction; merging a shard twice will duplicate its results.  The
+    result summary table is updated with the copied results, and shard
+    provenance records not already in the master database are also copied.
+
+    Parameters
+    ----------
+    database : `str`
+        Filepath to master SQLite database.
+    shards : `list`
+        Filepaths to shard SQLite databases.
+    pragmas : `bool` or `dict`
+        SQLite pragmas to apply to master database (see `get_engine`).
+
+    Returns
+    -------
+    nrows : `int`
+        Number of results merged.
+    """
+    engine = get_engine(database, pragmas=pragmas)
+    result_columns = [column.name for column in Result.__table__.columns
+                      if column.name not in ('id', 'aggressor_id', 'victim_id')]
+    provenance_columns = [column.name for column in Provenance.__table__.columns if column.name != 'id']
+
+    nrows = 0
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for shard in shards:
+            if os.path.abspath(shard) == os.path.abspath(database):
+                continue
+            if not os.path.exists(shard):
+                raise FileNotFoundError(shard)
+            cursor.execute('ATTACH DATABASE ? AS shard', (shard,))
+            try:
+                cursor.execute('BEGIN')
+
+                ## Add missing sensors and segments
+                cursor.execute(
+                    'INSERT INTO main.sensor (sensor_name, lsst_num, manufacturer, namps) '
+                    'SELECT DISTINCT s.sensor_name, s.lsst_num, s.manufacturer, s.namps '
+                    'FROM shard.sensor AS s WHERE NOT EXISTS '
+                    '(SELECT 1 FROM main.sensor AS m WHERE m.sensor_name IS s.sensor_name '
+                    'AND m.lsst_num IS s.lsst_num)')
+                cursor.execute('DROP TABLE IF EXISTS temp.sensor_map')
+                cursor.execute(
+                    'CREATE TEMP TABLE sensor_map AS '
+                    'SELECT s.id AS shard_id, MIN(m.id) AS main_id '
+                    'FROM shard.sensor AS s JOIN main.sensor AS m '
+                    'ON m.sensor_name IS s.sensor_name AND m.lsst_num IS s.lsst_num '
+                    'GROUP BY s.id')
+                cursor.execute(
+                    'INSERT INTO main.segment (segment_name, amplifier_number, sensor_id) '
+                    'SELECT DISTINCT g.segment_name, g.amplifier_number, sm.main_id '
+                    'FROM shard.segment AS g JOIN temp.sensor_map AS sm ON g.sensor_id = sm.shard_id '
+                    'WHERE NOT EXISTS (SELECT 1 FROM main.segment AS m '
+                    'WHERE m.sensor_id = sm.main_id AND m.amplifier_number IS g.amplifier_number)')
+                cursor.execute('DROP TABLE IF EXISTS temp.segment_map')
+                cursor.execute(
+                    'CREATE TEMP TABLE segment_map (shard_id INTEGER PRIMARY KEY, main_id INTEGER)')
+                cursor.execute(
+                    'INSERT INTO temp.segment_map (shard_id, main_id) '
+                    'SELECT g.id, MIN(m.id) FROM shard.segment AS g '
+                    'JOIN temp.sensor_map AS sm ON g.sensor_id = sm.shard_id '
+                    'JOIN main.segment AS m ON m.sensor_id = sm.main_id '
+                    'AND m.amplifier_number IS g.amplifier_number GROUP BY g.id')
+
+                ## Copy results with remapped segment keys
+                cursor.execute(
+                    'INSERT INTO main.result (aggressor_id, victim_id, {0}) '
+                    'SELECT a.main_id, v.main_id, {1} FROM shard.result AS r '
+                    'JOIN temp.segment_map AS a ON r.aggressor_id = a.shard_id '
+                    'JOIN temp.segment_map AS v ON r.victim_id = v.shard_id'.format(
+                        ', '.join(result_columns), ', '.join('r.' + name for name in result_columns)))
+                nrows += cursor.rowcount
+                cursor.execute(_summary_upsert('main.result_summary', 
+                                               'shard.result AS r '
+                                               'JOIN temp.segment_map AS a ON r.aggressor_id = a.shard_id '
+                                               'JOIN temp.segment_map AS v ON r.victim_id = v.shard_id',
+                                               aggressor_id='a.main_id', victim_id='v.main_id'))
+
+                ## Copy provenance of shard results
+                cursor.execute("SELECT 1 FROM shard.sqlite_master WHERE type = 'table' AND name = 'provenance'")
+                if cursor.fetchone() is not None:
+                    cursor.execute(
+                        'INSERT INTO main.provenance ({0}) SELECT {1} FROM shard.provenance AS p '
+                        'WHERE NOT EXISTS (SELECT 1 FROM main.provenance AS m '
+                        'WHERE m.analysis IS p.analysis AND m.sensor_name IS p.sensor_name '
+                        'AND m.file_hash IS p.file_hash AND m.config_hash IS p.config_hash)'.format(
+                            ', '.join(provenance_columns), ', '.join('p.' + name for name in provenance_columns)))
+                cursor.execute('DROP TABLE temp.sensor_map')
+                cursor.execute('DROP TABLE temp.segment_map')
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                raise e
+            finally:
+                cursor.execute('DETACH DATABASE shard')
+
+        ## Update query planner statistics
+        cursor.execute('ANALYZE')
+        connection.commit()
+    finally:
+        connection.close()
+
+    return nrows
@@ -1,12 +1,16 @@
 import os
+import time
+import shutil
+import logging
 import numpy as np
 from os.path import join
+from concurrent.futures import ProcessPoolExecutor
 from astropy.io import fits
 
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 
-from .sourcegrid import DistortedGrid, grid_fit, coordinate_distances
+from .sourcegrid import DistortedGrid, grid_fit, build_optics_grid, read_catalog_columns
 from .utils import ITL_AMP_GEOM, E2V_AMP_GEOM
 
 class GridFitConfig(pexConfig.Config):
@@ -24,7 +28,157 @@ class GridFitConfig(pexConfig.Config):
                                  default=False)
     fit_method = pexConfig.Field("Method for fit", str,
                                  default='least_squares')
+    analytic_jacobian = pexConfig.Field("Use analytic Jacobian for least_squares fit", bool,
+                                        default=True)
     outfile = pexConfig.Field("Output filename", str, default="test.cat")
+    output_mode = pexConfig.Field("Output mode (full, sidecar or append)", str, default='full')
+    num_workers = pexConfig.Field("Number of processes for batch fits", int, default=1)
+    warm_start_radius = pexConfig.Field("Max grid center distance (pixels) for warm start", float,
+                                        default=100.)
+    warm_start_min_confidence = pexConfig.Field("Min lattice estimate confidence for warm start", 
+                                                float, default=0.9)
+    optics_max_iter = pexConfig.Field("Max iterations for optics grid fit", int, default=5)
+    optics_tolerance = pexConfig.Field("Convergence tolerance (grid steps) for optics grid fit", 
+                                       float, default=1.E-3)
+    optics_min_count = pexConfig.Field("Min number of shifts for optics grid source", int, 
+                                       default=3)
+
+def grid_center_guess(infile, y_kwd='base_SdssCentroid_Y', x_kwd='base_SdssCentroid_X'):
+    """Make initial grid center guess from median position of good sources."""
+
+    columns = read_catalog_columns(infile, [y_kwd, x_kwd, 'base_SdssShape_XX', 
+                                            'base_SdssShape_YY'])
+    mask = (columns['base_SdssShape_XX'] > 4.5) \
+        *(columns['base_SdssShape_XX'] < 7.) \
+        *(columns['base_SdssShape_YY'] > 4.5) \
+        *(columns['base_SdssShape_YY'] < 7.)
+
+    y0_guess = np.nanmedian(columns[y_kwd][mask])
+    x0_guess = np.nanmedian(columns[x_kwd][mask])
+
+    return y0_guess, x0_guess
+
+def write_spotgrid(infile, outfile, spotgrid_hdu, grid_hdu, output_mode='full'):
+    """Write matched grid source columns and grid HDU for a source catalog.
+
+    Output modes are:
+        full: Copy of the source catalog with the columns added to the 
+            source table.
+        sidecar: Only the SPOTGRID table and GRID_INFO HDU, with the source
+            catalog filename in the SRCFILE keyword.
+        append: Copy of the source catalog (or the source catalog itself,
+            if the filenames are the same) with SPOTGRID table and GRID_INFO 
+            HDU appended, without rewriting the source table.
+
+    Existing grid fit columns and HDUs are replaced.
+    """
+    if output_mode == 'full':
+        with fits.open(infile) as src:
+            new_cols = spotgrid_hdu.columns
+            cols = fits.ColDefs([col for col in src[1].columns 
+                                 if col.name not in new_cols.names])
+            src[1] = fits.BinTableHDU.from_columns(cols+new_cols)
+            for extname in ('SPOTGRID', 'GRID_INFO'):
+                if extname in src:
+                    del src[extname]
+            src.append(grid_hdu)
+            src.writeto(outfile, overwrite=True)
+
+    elif output_mode == 'sidecar':
+        hdr = fits.Header()
+        hdr['SRCFILE'] = os.path.abspath(infile)
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=hdr), spotgrid_hdu, grid_hdu])
+        hdulist.writeto(outfile, overwrite=True)
+
+    elif output_mode == 'append':
+        if os.path.abspath(infile) != os.path.abspath(outfile):
+            shutil.copyfile(infile, outfile)
+        with fits.open(outfile, memmap=True) as hdulist:
+            has_existing = ('SPOTGRID' in hdulist) or ('GRID_INFO' in hdulist)
+        with fits.open(outfile, mode='update' if has_existing else 'append') as hdulist:
+            for extname in ('SPOTGRID', 'GRID_INFO'):
+                if extname in hdulist:
+                    del hdulist[extname]
+            hdulist.append(spotgrid_hdu)
+            hdulist.append(grid_hdu)
+    else:
+        raise ValueError('Unknown output mode: {0}'.format(output_mode))
+
+def position_order(grid_center_guesses):
+    """Order exposures so that each is followed by its nearest remaining neighbor.
+
+    Starting from the exposure with the smallest grid center guess, this walks
+    the scan positions greedily, so consecutive fits are at nearby positions.
+    """
+    positions = np.asarray(grid_center_guesses, dtype=float).reshape(-1, 2)
+    remaining = np.ones(positions.shape[0], dtype=bool)
+    order = []
+    if positions.shape[0] == 0:
+        return np.asarray(order, dtype=int)
+
+    i = np.lexsort((positions[:, 1], positions[:, 0]))[0]
+    while True:
+        order.append(i)
+        remaining[i] = False
+        if not np.any(remaining):
+            break
+        dist = np.hypot(*(positions - positions[i]).T)
+        dist[~remaining] = np.inf
+        i = int(np.argmin(dist))
+
+    return np.asarray(order, dtype=int)
+
+def _fit_sequence(config, jobs, ccd_type=None, optics_grid_file=None):
+    """Fit a sequence of catalogs, warm starting from the previous solution.
+
+    This runs in a worker process of `GridFitTask.run_batch` and returns
+    one summary row per catalog.
+    """
+    task = GridFitTask()
+    task.config.update(**config)
+
+    rows = []
+    previous = None
+    for infile, outfile, guess in jobs:
+
+        ## Seed lattice from previous solution at a nearby position
+        lattice = None
+        if previous is not None:
+            prev_guess, prev_lattice = previous
+            if np.hypot(guess[0]-prev_guess[0], guess[1]-prev_guess[1]) <= task.config.warm_start_radius:
+                lattice = prev_lattice
+
+        task.config.outfile = outfile
+        start = time.perf_counter()
+        try:
+            grid, result = task.run(infile, guess, ccd_type=ccd_type,
+                                    optics_grid_file=optics_grid_file,
+                                    vary_steps=True, lattice=lattice)
+        except Exception as e:
+            logging.exception("Grid fit failed for {0}: {1}".format(infile, e))
+            rows.append((infile, outfile, guess[0], guess[1], np.nan, np.nan, np.nan, np.nan,
+                         np.nan, np.nan, np.nan, 0, False, False, np.nan,
+                         time.perf_counter()-start))
+            previous = None
+            continue
+        elapsed = time.perf_counter() - start
+
+        parvals = result.params.valuesdict()
+        rows.append((infile, outfile, guess[0], guess[1], parvals['y0'], parvals['x0'],
+                     parvals['theta'], parvals['ystep'], parvals['xstep'], result.chisqr,
+                     result.redchi, result.nfev, result.success, result.warm_start,
+                     result.lattice_confidence, elapsed))
+        if result.success:
+            previous = (guess, (parvals['ystep'], parvals['xstep'], parvals['theta']))
+        else:
+            previous = None
+
+    return rows
+
+SUMMARY_COLUMNS = [('INFILE', 'A'), ('OUTFILE', 'A'), ('Y0_GUESS', 'D'), ('X0_GUESS', 'D'),
+                   ('Y0', 'D'), ('X0', 'D'), ('THETA', 'D'), ('YSTEP', 'D'), ('XSTEP', 'D'),
+                   ('CHISQR', 'D'), ('REDCHI', 'D'), ('NFEV', 'J'), ('SUCCESS', 'L'),
+                   ('WARM_START', 'L'), ('LATTICE_CONFIDENCE', 'D'), ('FIT_TIME', 'D')]
 
 class GridFitTask(pipeBase.Task):
 
@@ -33,7 +187,7 @@ class GridFitTask(pipeBase.Task):
 
     @pipeBase.timeMethod
     def run(self, infile, grid_center_guess, ccd_type=None, 
-            optics_grid_file=None):
+            optics_grid_file=None, vary_steps=False, lattice=None):
 
         y0_guess, x0_guess = grid_center_guess
 
@@ -51,76 +205,208 @@ class GridFitTask(pipeBase.Task):
         else:
             ccd_geom = None
 
-        ## Get source positions for fit
-        with fits.open(infile) as src:
+        ## Get source positions for fit, reading only the needed columns
+        columns = read_catalog_columns(infile, [y_kwd, x_kwd, xx_kwd, yy_kwd,
+                                                'base_SdssCentroid_Y', 
+                                                'base_SdssCentroid_X'])
+        all_srcY = columns[y_kwd]
+        all_srcX = columns[x_kwd]
 
-            all_srcY = src[1].data[y_kwd]
-            all_srcX = src[1].data[x_kwd]
-
-            ## Curate data here (remove bad shapes, fluxes, etc.)
-            mask = (src[1].data['base_SdssShape_XX'] > 4.5) \
-                *(src[1].data['base_SdssShape_XX'] < 7.) \
-                *(src[1].data['base_SdssShape_YY'] > 4.5) \
-                *(src[1].data['base_SdssShape_YY'] < 7.) \
-                *(src[1].data['base_SdssCentroid_Y'] < y0_guess+70*25) \
-                *(src[1].data['base_SdssCentroid_Y'] > y0_guess-70*25) \
-                *(src[1].data['base_SdssCentroid_X'] < x0_guess+70*25) \
-                *(src[1].data['base_SdssCentroid_X'] > x0_guess-70*25)
-
-            srcY = all_srcY[mask]
-            srcX = all_srcX[mask]
-
-            ## Optionally get existing normalized centroid shifts
-            if optics_grid_file is not None:
-                optics_grid = DistortedGrid.from_fits(optics_grid_file)
-                normalized_shifts = (optics_grid.norm_dy, optics_grid.norm_dx)
-            else:
-                normalized_shifts = None
-
-            ## Perform grid fit
-            ncols = self.config.ncols
-            nrows = self.config.nrows
-            result = grid_fit(srcY, srcX, y0_guess, x0_guess, ncols, nrows,
-                              brute_search=self.config.brute_search,
-                              vary_theta=self.config.vary_theta,
-                              normalized_shifts=normalized_shifts,
-                              method=self.config.fit_method,
-                              ccd_geom=ccd_geom)
-
-            ## Make best fit source grid
-            parvals = result.params.valuesdict()
-            grid = DistortedGrid(parvals['ystep'], parvals['xstep'], 
-                                 parvals['theta'], parvals['y0'], 
-                                 parvals['x0'], ncols, nrows, 
-                                 normalized_shifts=normalized_shifts)
-
-            ## Match grid to catalog
-            gY, gX = grid.get_source_centroids()
-            indices, dist = coordinate_distances(gY, gX, all_srcY, all_srcX)
-            nn_indices = indices[:, 0]
-
-            ## Populate grid information
-            grid_index = np.full(all_srcX.shape[0], np.nan)
-            grid_y = np.full(all_srcX.shape[0], np.nan)
-            grid_x = np.full(all_srcX.shape[0], np.nan)
-            grid_y[nn_indices] = gY
-            grid_x[nn_indices] = gX
-            grid_index[nn_indices] = np.arange(49*49)
-
-            ## Merge tables
-            new_cols = fits.ColDefs([fits.Column(name='spotgrid_index', 
-                                                 format='D', array=grid_index),
-                                     fits.Column(name='spotgrid_x', 
-                                                 format='D', array=grid_x),
-                                     fits.Column(name='spotgrid_y', 
-                                                 format='D', array=grid_y)])
-            cols = src[1].columns
-            new_hdu = fits.BinTableHDU.from_columns(cols+new_cols)
-            src[1] = new_hdu
-
-            ## Append grid HDU
-            grid_hdu = grid.make_grid_hdu()
-            src.append(grid_hdu)
-            src.writeto(self.config.outfile, overwrite=True)
+        ## Curate data here (remove bad shapes, fluxes, etc.)
+        mask = (columns[xx_kwd] > 4.5) \
+            *(columns[xx_kwd] < 7.) \
+            *(columns[yy_kwd] > 4.5) \
+            *(columns[yy_kwd] < 7.) \
+            *(columns['base_SdssCentroid_Y'] < y0_guess+70*25) \
+            *(columns['base_SdssCentroid_Y'] > y0_guess-70*25) \
+            *(columns['base_SdssCentroid_X'] < x0_guess+70*25) \
+            *(columns['base_SdssCentroid_X'] > x0_guess-70*25)
+
+        srcY = all_srcY[mask]
+        srcX = all_srcX[mask]
+
+        ## Optionally get existing normalized centroid shifts
+        if optics_grid_file is not None:
+            optics_grid = DistortedGrid.from_fits(optics_grid_file)
+            normalized_shifts = (optics_grid.norm_dy, optics_grid.norm_dx)
+        else:
+            normalized_shifts = None
+
+        ## Perform grid fit
+        ncols = self.config.ncols
+        nrows = self.config.nrows
+        result = grid_fit(srcY, srcX, y0_guess, x0_guess, ncols, nrows,
+                          brute_search=self.config.brute_search,
+                          vary_theta=self.config.vary_theta,
+                          normalized_shifts=normalized_shifts,
+                          method=self.config.fit_method,
+                          ccd_geom=ccd_geom,
+                          analytic_jacobian=self.config.analytic_jacobian,
+                          vary_steps=vary_steps, lattice=lattice,
+                          min_confidence=self.config.warm_start_min_confidence)
+
+        ## Make best fit source grid
+        parvals = result.params.valuesdict()
+        grid = DistortedGrid(parvals['ystep'], parvals['xstep'], 
+                             parvals['theta'], parvals['y0'], 
+                             parvals['x0'], ncols, nrows, 
+                             normalized_shifts=normalized_shifts)
+
+        ## Match catalog to grid, keeping nearest source to each grid source
+        gY, gX = grid.get_source_centroids()
+        indices, dy, dx = grid.locate(all_srcY, all_srcX)
+        dist = np.hypot(dy, dx)
+        order = np.lexsort((dist, indices))
+        order = order[indices[order] >= 0]
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = indices[order][1:] != indices[order][:-1]
+        nn_indices = order[first]
+
+        ## Populate grid information
+        grid_index = np.full(all_srcX.shape[0], np.nan)
+        grid_y = np.full(all_srcX.shape[0], np.nan)
+        grid_x = np.full(all_srcX.shape[0], np.nan)
+        grid_y[nn_indices] = gY[indices[nn_indices]]
+        grid_x[nn_indices] = gX[indices[nn_indices]]
+        grid_index[nn_indices] = indices[nn_indices]
+
+        ## Write matched grid sources and grid HDU
+        spotgrid_hdu = fits.BinTableHDU.from_columns([fits.Column(name='spotgrid_index', 
+                                                                  format='D', array=grid_index),
+                                                      fits.Column(name='spotgrid_x', 
+                                                                  format='D', array=grid_x),
+                                                      fits.Column(name='spotgrid_y', 
+                                                                  format='D', array=grid_y)],
+                                                     name='SPOTGRID')
+        write_spotgrid(infile, self.config.outfile, spotgrid_hdu, grid.make_grid_hdu(),
+                       output_mode=self.config.output_mode)
 
         return grid, result
+
+    def run_batch(self, infiles, grid_center_guesses=None, ccd_type=None,
+                  optics_grid_file=None, output_dir='./', summary_file=None):
+        """Fit many catalogs of a grid scan in a local process pool.
+
+        Catalogs are ordered by grid center guess and split into contiguous
+        sequences, one per worker.  The grid steps are fit for every catalog,
+        before any rotation fit.  Within a sequence, the grid steps of the 
+        previous successful fit seed the step fit of the next, if its grid
+        center is within the configured warm start radius, unless the lattice 
+        estimate of the catalog has low confidence or disagrees with them.
+        Output catalogs are written to ``<output_dir>/<root>_gridfit.cat``.
+
+        Args:
+            infiles: List of source catalog filenames.
+            grid_center_guesses: List of (y0, x0) grid center guesses.  If None,
+                guesses are made from the median source positions.
+            ccd_type: CCD manufacturer type (ITL or E2V).
+            optics_grid_file: FITS file with normalized centroid shifts.
+            output_dir: Output directory for grid fit catalogs.
+            summary_file: Optional FITS filename for the summary table.
+
+        Returns:
+            BinTableHDU summary table of per-catalog fit parameters and timings.
+        """
+        if grid_center_guesses is None:
+            grid_center_guesses = [grid_center_guess(infile, y_kwd=self.config.y_kwd,
+                                                     x_kwd=self.config.x_kwd) for infile in infiles]
+        os.makedirs(output_dir, exist_ok=True)
+
+        jobs = []
+        for infile, guess in zip(infiles, grid_center_guesses):
+            root = os.path.splitext(os.path.basename(infile))[0]
+            outfile = join(output_dir, '{0}_gridfit.cat'.format(root))
+            jobs.append((infile, outfile, (float(guess[0]), float(guess[1]))))
+        jobs = [jobs[i] for i in position_order(grid_center_guesses)]
+
+        ## Split into one contiguous sequence per worker
+        num_workers = max(1, min(self.config.num_workers, len(jobs)))
+        sequences = [list(seq) for seq in np.array_split(np.arange(len(jobs)), num_workers)]
+        sequences = [[jobs[i] for i in seq] for seq in sequences if len(seq) > 0]
+        config = self.config.toDict()
+
+        if num_workers == 1:
+            results = [_fit_sequence(config, seq, ccd_type, optics_grid_file) for seq in sequences]
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(_fit_sequence, config, seq, ccd_type, optics_grid_file)
+                           for seq in sequences]
+                results = [future.result() for future in futures]
+        rows = [row for seq_rows in results for row in seq_rows]
+
+        ## Make summary table
+        columns = []
+        for i, (name, fmt) in enumerate(SUMMARY_COLUMNS):
+            array = [row[i] for row in rows]
+            if fmt == 'A':
+                width = max([len(value) for value in array] + [1])
+                fmt = '{0}A'.format(width)
+            columns.append(fits.Column(name=name, format=fmt, array=np.asarray(array)))
+        summary_hdu = fits.BinTableHDU.from_columns(columns)
+        summary_hdu.name = 'GRIDFIT_SUMMARY'
+        if summary_file is not None:
+            summary_hdu.writeto(summary_file, overwrite=True)
+
+        return summary_hdu
+
+    def run_optics_grid(self, infiles, grid_center_guesses=None, ccd_type=None,
+                        optics_grid_file=None, output_dir='./'):
+        """Iteratively fit grids and normalized centroid shifts for a grid scan.
+
+        Each iteration fits all catalogs with the current normalized shifts
+        (see `run_batch`), then builds new normalized shifts from the grid fit
+        catalogs.  Iteration stops when the largest change in the shifts is
+        less than the configured tolerance.  Each iteration writes its grid 
+        fit catalogs, summary table and optics grid to ``iter<N>``
+        subdirectories of the output directory.
+
+        Args:
+            infiles: List of source catalog filenames.
+            grid_center_guesses: List of (y0, x0) grid center guesses.
+            ccd_type: CCD manufacturer type (ITL or E2V).
+            optics_grid_file: Optional FITS file with initial normalized shifts.
+            output_dir: Output directory.
+
+        Returns:
+            Tuple of final optics grid filename and DistortedGrid.
+        """
+        if grid_center_guesses is None:
+            grid_center_guesses = [grid_center_guess(infile, y_kwd=self.config.y_kwd,
+                                                     x_kwd=self.config.x_kwd) for infile in infiles]
+        if optics_grid_file is not None:
+            optics_grid = DistortedGrid.from_fits(optics_grid_file)
+        else:
+            optics_grid = None
+
+        for i in range(self.config.optics_max_iter):
+
+            iter_dir = join(output_dir, 'iter{0:02d}'.format(i))
+            os.makedirs(iter_dir, exist_ok=True)
+            summary = self.run_batch(infiles, grid_center_guesses=grid_center_guesses,
+                                     ccd_type=ccd_type, optics_grid_file=optics_grid_file,
+                                     output_dir=iter_dir, 
+                                     summary_file=join(iter_dir, 'gridfit_summary.fits'))
+            gridfit_files = [outfile for outfile, success in zip(summary.data['OUTFILE'],
+                                                                 summary.data['SUCCESS']) if success]
+
+            ## Build new normalized shifts from grid fit residuals
+            new_optics_grid_file = join(iter_dir, 'optics_grid.fits')
+            new_optics_grid, builder = build_optics_grid(gridfit_files, outfile=new_optics_grid_file,
+                                                         ncols=self.config.ncols, 
+                                                         nrows=self.config.nrows,
+                                                         min_count=self.config.optics_min_count,
+                                                         y_kwd=self.config.y_kwd, 
+                                                         x_kwd=self.config.x_kwd)
+            if optics_grid is not None:
+                change = max(np.max(np.abs(new_optics_grid.norm_dy - optics_grid.norm_dy)),
+                             np.max(np.abs(new_optics_grid.norm_dx - optics_grid.norm_dx)))
+            else:
+                change = np.inf
+            logging.info("Optics grid iteration {0}: max shift change {1:.3g}".format(i, change))
+
+            optics_grid = new_optics_grid
+            optics_grid_file = new_optics_grid_file
+            if change < self.config.optics_tolerance:
+                break
+
+        return optics_grid_file, optics_grid
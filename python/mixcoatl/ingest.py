@@ -0,0 +1,364 @@
+"""Single-writer ingestion of crosstalk results.
+
+SQLite allows only one writer at a time, so many crosstalk tasks writing to
+the same database file contend for the database lock.  Instead, each task
+can write its results as batch files to a spool directory using
+`SpoolWriter`, and a single `IngestionService` process polls the spool
+directory and commits the results to the database.
+
+Spool files are written to a hidden temporary file and renamed into place,
+so the service never reads a partially written batch.  Results from all
+spool files found in a poll are committed in a single transaction before the
+files are removed; if the service is stopped between the commit and the
+removal, those files will be ingested again on restart.  A spool file that
+cannot be read or ingested is renamed with a `FAILED_SUFFIX` and left in 
+the spool directory for inspection, and the remaining files are ingested.
+
+If a provenance record is given, all results of a task run are written to
+a single spool file and ingested in the same transaction as the record.
+"""
+import os
+import glob
+import json
+import time
+import socket
+import logging
+from datetime import datetime
+from contextlib import contextmanager
+import numpy as np
+from sqlalchemy.exc import OperationalError
+
+from mixcoatl.database import Provenance, ResultWriter, db_session, get_or_create_sensor
+
+SPOOL_SUFFIX = '.npz'
+PROCESSING_SUFFIX = '.ingesting'
+FAILED_SUFFIX = '.failed'
+
+class SpoolFileError(Exception):
+    """Error ingesting the results of a single spool file."""
+
+    def __init__(self, spool_file):
+        super().__init__('Failed to ingest spool file {0}'.format(spool_file))
+        self.spool_file = spool_file
+
+class SpoolWriter():
+    """Writer for crosstalk results to a spool directory.
+
+    Results are gathered for each aggressor amplifier and written as a
+    batch file, with the sensor information and common column values,
+    for ingestion by an `IngestionService`.  This matches the interface of
+    `mixcoatl.database.ResultWriter`.
+
+    Parameters
+    ----------
+    spool_dir : `str`
+        Spool directory.
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    lsst_num : `str`
+        LSST project number.
+    manufacturer : `str`
+        Manufacturer (E2V or ITL).
+    segments : `dict`
+        Segment names, keyed by amplifier number.
+    batch_size : `int`
+        Number of results to gather before writing each batch file.
+    provenance : `dict`, optional
+        Provenance column values for the task run.  All results are then
+        written to one spool file by `flush`.
+    **columns
+        Column values common to all results (e.g. methodology, image_type,
+        teststand, analysis, is_coadd).
+    """
+
+    def __init__(self, spool_dir, sensor_name, lsst_num, manufacturer, segments,
+                 batch_size=10000, provenance=None, **columns):
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.spool_dir = spool_dir
+        self.metadata = {'sensor_name' : sensor_name, 'lsst_num' : lsst_num,
+                         'manufacturer' : manufacturer,
+                         'segments' : {str(i) : name for i, name in segments.items()},
+                         'columns' : columns, 'provenance' : provenance}
+        self.batch_size = batch_size
+        self.nrows = 0
+        self.nfiles = 0
+        self._rows = []
+
+    def add_row(self, aggressor_amp, victim_amps, signal, coefficients, errors):
+        """Add crosstalk results for a single aggressor amplifier.
+
+        Parameters
+        ----------
+        aggressor_amp : `int`
+            Aggressor amplifier number.
+        victim_amps : `list`
+            Victim amplifier numbers.
+        signal : `float`
+            Pixel signal of aggressor.
+        coefficients : array-like
+            Crosstalk coefficient for each victim amplifier.
+        errors : array-like
+            Error estimate of crosstalk coefficient for each victim amplifier.
+        """
+        for victim_amp, coefficient, error in zip(victim_amps, coefficients, errors):
+            self._rows.append((aggressor_amp, victim_amp, signal, coefficient, error))
+
+        if self.metadata['provenance'] is None and len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write gathered results to a new spool file."""
+
+        if len(self._rows) == 0 and self.metadata['provenance'] is None:
+            return
+        aggressor_amp, victim_amp, signal, coefficient, error = np.asarray(self._rows).reshape(-1, 5).T
+
+        ## Unique name, ordered by creation time
+        basename = '{0:d}_{1}_{2:d}_{3:d}{4}'.format(time.time_ns(), socket.gethostname(),
+                                                    os.getpid(), self.nfiles, SPOOL_SUFFIX)
+        tmpfile = os.path.join(self.spool_dir, '.' + basename)
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, aggressor_amp=np.asarray(aggressor_amp, dtype=np.int32),
+                     victim_amp=np.asarray(victim_amp, dtype=np.int32),
+                     aggressor_signal=np.asarray(signal, dtype=np.float64),
+                     coefficient=np.asarray(coefficient, dtype=np.float64),
+                     error=np.asarray(error, dtype=np.float64),
+                     metadata=np.asarray(json.dumps(self.metadata)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, os.path.join(self.spool_dir, basename))
+
+        self.nrows += len(self._rows)
+        self.nfiles += 1
+        self._rows = []
+
+def read_spool_file(spool_file):
+    """Read crosstalk results from a spool file.
+
+    Parameters
+    ----------
+    spool_file : `str`
+        Spool file written by `SpoolWriter`.
+
+    Returns
+    -------
+    metadata : `dict`
+        Sensor information and common column values.
+    results : `dict`
+        Arrays of aggressor amplifier, victim amplifier, aggressor signal,
+        coefficient and error.
+    """
+    with np.load(spool_file) as data:
+        metadata = json.loads(str(data['metadata']))
+        results = {key : data[key] for key in data.files if key != 'metadata'}
+
+    return metadata, results
+
+class IngestionService():
+    """Single database writer for crosstalk results in a spool directory.
+
+    Parameters
+    ----------
+    database : `str`
+        Filepath to SQLite database.
+    spool_dir : `str`
+        Spool directory.
+    poll_interval : `float`
+        Time (seconds) to wait between polls of an empty spool directory.
+    pragmas : `bool` or `dict`
+        SQLite pragmas to apply (see `mixcoatl.database.get_engine`).
+    """
+
+    def __init__(self, database, spool_dir, poll_interval=5., pragmas=False):
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.database = database
+        self.spool_dir = spool_dir
+        self.poll_interval = poll_interval
+        self.pragmas = pragmas
+        self.nrows = 0
+
+    def recover(self):
+        """Return spool files claimed by a previously stopped service."""
+
+        for claimed in glob.glob(os.path.join(self.spool_dir, '*' + PROCESSING_SUFFIX)):
+            os.replace(claimed, claimed[:-len(PROCESSING_SUFFIX)])
+
+    def quarantine(self, claimed):
+        """Move a claimed spool file that failed ingestion aside."""
+
+        failed = claimed[:-len(PROCESSING_SUFFIX)] + FAILED_SUFFIX
+        os.replace(claimed, failed)
+        logging.exception("{0}  Failed to ingest {1}, moved to {2}".format(datetime.now(), claimed, 
+                                                                          failed))
+
+    def _ingest(self, spool_data):
+        """Commit the results of read spool files in one transaction.
+
+        Database errors (e.g. a locked database) are raised as they are,
+        and any other error is raised as a `SpoolFileError` for the spool
+        file being ingested.
+        """
+
+        nrows = 0
+        with db_session(self.database, pragmas=self.pragmas) as session:
+            for claimed, metadata, results in spool_data:
+                try:
+                    sensor = get_or_create_sensor(session, metadata['sensor_name'], metadata['lsst_num'],
+                                                  metadata['manufacturer'], metadata['segments'])
+                    writer = ResultWriter(session, sensor, batch_size=len(results['coefficient'])+1,
+                                          commit=False, **metadata['columns'])
+                    for row in zip(results['aggressor_amp'], results['victim_amp'],
+                                   results['aggressor_signal'], results['coefficient'],
+                                   results['error']):
+                        aggressor_amp, victim_amp, signal, coefficient, error = row
+                        writer.add_row(int(aggressor_amp), [int(victim_amp)], signal,
+                                       [coefficient], [error])
+                    writer.flush()
+                    if metadata.get('provenance') is not None:
+                        provenance = Provenance(nresults=writer.nrows, **metadata['provenance'])
+                        provenance.add_to_db(session)
+                        session.flush()
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    raise SpoolFileError(claimed) from e
+                nrows += writer.nrows
+
+        return nrows
+
+    def ingest_pending(self):
+        """Ingest all spool files currently in the spool directory.
+
+        Spool files that cannot be read or ingested are quarantined (see
+        `quarantine`) and the transaction is retried without them.  If the
+        transaction fails for another reason (e.g. the database is locked),
+        the remaining spool files are returned to the spool directory and
+        the error is raised.
+
+        Returns
+        -------
+        nrows : `int`
+            Number of results ingested.
+        """
+        spool_files = sorted(glob.glob(os.path.join(self.spool_dir, '*' + SPOOL_SUFFIX)))
+        if len(spool_files) == 0:
+            return 0
+
+        ## Claim spool files
+        claimed_files = []
+        for spool_file in spool_files:
+            claimed = spool_file + PROCESSING_SUFFIX
+            os.replace(spool_file, claimed)
+            claimed_files.append(claimed)
+
+        ## Read spool files
+        spool_data = []
+        for claimed in claimed_files:
+            try:
+                metadata, results = read_spool_file(claimed)
+            except Exception:
+                self.quarantine(claimed)
+            else:
+                spool_data.append((claimed, metadata, results))
+
+        ## Commit all results in one transaction, retrying without failed files
+        nrows = 0
+        while len(spool_data) > 0:
+            try:
+                nrows = self._ingest(spool_data)
+            except SpoolFileError as e:
+                self.quarantine(e.spool_file)
+                spool_data = [data for data in spool_data if data[0] != e.spool_file]
+            except Exception:
+                self.recover()
+                raise
+            else:
+                break
+
+        for claimed, metadata, results in spool_data:
+            os.remove(claimed)
+        self.nrows += nrows
+        logging.info("{0}  Ingested {1} results from {2} spool files".format(datetime.now(), nrows,
+                                                                            len(spool_data)))
+
+        return nrows
+
+    def run(self, max_idle=None):
+        """Poll the spool directory and ingest results.
+
+        Errors other than those of single spool files are logged and the
+        spool directory is polled again after the poll interval.
+
+        Parameters
+        ----------
+        max_idle : `float`, optional
+            Stop after the spool directory is empty for this time (seconds).
+            If `None`, run until interrupted.
+        """
+        self.recover()
+        idle_start = time.monotonic()
+        while True:
+            try:
+                nrows = self.ingest_pending()
+            except Exception:
+                logging.exception("{0}  Ingestion failed, retrying".format(datetime.now()))
+                time.sleep(self.poll_interval)
+                continue
+            if nrows > 0:
+                idle_start = time.monotonic()
+            elif max_idle is not None and time.monotonic() - idle_start >= max_idle:
+                break
+            else:
+                time.sleep(self.poll_interval)
+
+@contextmanager
+def open_result_writer(database, sensor_name, lsst_num, manufacturer, segments, spool_dir=None,
+                       pragmas=False, batch_size=10000, provenance=None, **columns):
+    """Define a context manager for a crosstalk results writer.
+
+    Results are written to the database directly, or to a spool directory
+    for ingestion by an `IngestionService` if ``spool_dir`` is given.
+    Remaining results are flushed on exit.  If a provenance record is given,
+    it is committed in the same transaction as all of the results, so an
+    interrupted task run leaves neither behind.
+
+    Parameters
+    ----------
+    database : `str`
+        Filepath to SQLite database.
+    sensor_name : `str`
+        Sensor name (e.g. R22/S22).
+    lsst_num : `str`
+        LSST project number.
+    manufacturer : `str`
+        Manufacturer (E2V or ITL).
+    segments : `dict`
+        Segment names, keyed by amplifier number.
+    spool_dir : `str`, optional
+        Spool directory.
+    pragmas : `bool` or `dict`
+        SQLite pragmas to apply (see `mixcoatl.database.get_engine`).
+    batch_size : `int`
+        Number of results per database insert or spool file.
+    provenance : `dict`, optional
+        Provenance column values for the task run (see 
+        `mixcoatl.database.input_provenance`).
+    **columns
+        Column values common to all results.
+    """
+    if spool_dir is not None:
+        writer = SpoolWriter(spool_dir, sensor_name, lsst_num, manufacturer, segments,
+                             batch_size=batch_size, provenance=provenance, **columns)
+        yield writer
+        writer.flush()
+    else:
+        with db_session(database, pragmas=pragmas) as session:
+            sensor = get_or_create_sensor(session, sensor_name, lsst_num, manufacturer, segments)
+            writer = ResultWriter(session, sensor, batch_size=batch_size, 
+                                  commit=provenance is None, **columns)
+            yield writer
+            writer.flush()
+            if provenance is not None:
+                Provenance(nresults=writer.nrows, **provenance).add_to_db(session)
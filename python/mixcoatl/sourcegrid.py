@@ -8,12 +8,13 @@ To Do:
 from __future__ import print_function
 from __future__ import absolute_import
 import os
+import re
 import scipy
 import numpy as np
 from astropy.io import fits
 from lmfit import Minimizer, Parameters
 from scipy import optimize
-from scipy.spatial import distance
+from scipy.spatial import distance, cKDTree
 from itertools import product
 
 class DistortedGrid:
@@ -33,10 +34,10 @@ class DistortedGrid:
         self.make_source_grid()
 
         ## Add centroid shifts
-        if normalized_shifts is None:
-            self._norm_dy = np.zeros(nrows*ncols)
-            self._norm_dx = np.zeros(nrows*ncols)
-        else:
+        self._norm_dy = np.zeros(nrows*ncols)
+        self._norm_dx = np.zeros(nrows*ncols)
+        self._distorted_basis = self._basis
+        if normalized_shifts is not None:
             self.add_normalized_shifts(normalized_shifts)
 
     @classmethod
@@ -56,7 +57,7 @@ class DistortedGrid:
             norm_dy = hdulist['GRID_INFO'].data['NORMALIZED_DY']
             norm_dx = hdulist['GRID_INFO'].data['NORMALIZED_DX']
 
-        return cls(ystep, xstep, theta, y0, x0, nrows, ncols, 
+        return cls(ystep, xstep, theta, y0, x0, ncols, nrows, 
                    normalized_shifts=(norm_dy, norm_dx))
     
     @property
@@ -69,11 +70,20 @@ class DistortedGrid:
 
     @property
     def x(self):
-        return self._x
+        return self._basis[0]*self.xstep
 
     @property
     def y(self):
-        return self._y
+        return self._basis[1]*self.ystep
+
+    def set_params(self, ystep, xstep, theta, y0, x0):
+        """Set the ideal grid parameters."""
+
+        self.ystep = ystep
+        self.xstep = xstep
+        self.theta = theta
+        self.y0 = y0
+        self.x0 = x0
 
     def add_centroid_shifts(self, centroid_shifts):
         """Calculate and add the normalized source centroid shifts."""
@@ -96,6 +106,11 @@ class DistortedGrid:
             self._norm_dy = norm_dy
             self._norm_dx = norm_dx
 
+            ## Shifted grid in units of grid steps
+            self._distorted_basis = self._basis.copy()
+            self._distorted_basis[0] += norm_dx
+            self._distorted_basis[1] += norm_dy
+
     def make_grid_hdu(self):
         """Create an HDU with grid information."""
 
@@ -119,15 +134,15 @@ class DistortedGrid:
     def make_source_grid(self):
         """Make rectilinear grid of sources."""
 
-        ## Create a standard nrows x ncols grid of points
-        y_array = np.asarray([n*self.ystep - (self.nrows-1)*self.ystep/2. \
-                                  for n in range(self.nrows)])
-        x_array = np.asarray([n*self.xstep - (self.ncols-1)*self.xstep/2. \
-                                  for n in range(self.ncols)])
-        y, x = np.meshgrid(y_array, x_array)
+        ## Create a standard nrows x ncols grid of points in units of grid steps
+        y_array = np.arange(self.nrows) - (self.nrows-1)/2.
+        x_array = np.arange(self.ncols) - (self.ncols-1)/2.
 
-        self._y = y.flatten()
-        self._x = x.flatten()
+        ## Rows of x, y and one for each point (column-major ordering)
+        self._basis = np.ones((3, self.nrows*self.ncols))
+        self._basis[0] = np.repeat(x_array, self.nrows)
+        self._basis[1] = np.tile(y_array, self.ncols)
+        self._centroids = np.empty((2, self.nrows*self.ncols))
 
     def get_centroid_shifts(self):
         """Return the centroid shifts given the grid geometry."""
@@ -137,27 +152,85 @@ class DistortedGrid:
 
         return dy, dx
 
-    def get_source_centroids(self, distorted=True):
-        """Return source centroids given the grid geometry."""
-
-        ## Add scaled centroid shifts
+    def get_source_centroids(self, distorted=True, out=None):
+        """Return source centroids given the grid geometry.
+
+        Args:
+            distorted (bool): Add centroid shifts.
+            out (numpy.ndarray): Optional (2, N) array to store centroids,
+                avoiding allocation when evaluated repeatedly.
+
+        Returns:
+            Tuple of arrays of source y-positions and x-positions.
+        """
+        if out is None:
+            out = np.empty((2, self.nrows*self.ncols))
+
+        ## Scale, rotate and move center of grid as one affine transform
+        cos = np.cos(self.theta)
+        sin = np.sin(self.theta)
+        transform = np.asarray([[sin*self.xstep, cos*self.ystep, self.y0],
+                                [cos*self.xstep, -sin*self.ystep, self.x0]])
         if distorted:
-            y = self.y + self.norm_dy*self.ystep
-            x = self.x + self.norm_dx*self.xstep
+            np.matmul(transform, self._distorted_basis, out=out)
         else:
-            y = self.y
-            x = self.x
-        
-        ## Rotate grid using rotation matrix
-        xr = (np.cos(self.theta)*x - np.sin(self.theta)*y).flatten()
-        yr = (np.sin(self.theta)*x + np.cos(self.theta)*y).flatten()
-        
-        ## Move center of grid to desired x/y center coordinates
-        xr += self.x0
-        yr += self.y0
-        
-        ## Return the flattened arrays
-        return yr, xr
+            np.matmul(transform, self._basis, out=out)
+
+        return out[0], out[1]
+
+    def locate(self, y, x):
+        """Return the nearest grid source and residuals for positions.
+
+        Positions are transformed to the unrotated grid frame and rounded 
+        to the nearest row and column.  If the grid has centroid shifts, 
+        the nearest distorted source is then found among the 3x3 
+        neighboring grid sources, or among all grid sources for positions
+        more than a grid step from the grid.
+
+        Args:
+            y (numpy.ndarray): Array of y-positions.
+            x (numpy.ndarray): Array of x-positions.
+
+        Returns:
+            Tuple of arrays of grid source indices (-1 for non-finite
+            positions) and y/x residuals (position minus grid source 
+            centroid).
+        """
+        y = np.asarray(y, dtype=float)
+        x = np.asarray(x, dtype=float)
+        gY, gX = self.get_source_centroids(out=self._centroids)
+
+        ## Transform to unrotated grid frame and round to nearest row/column
+        dy = y - self.y0
+        dx = x - self.x0
+        u = (np.cos(self.theta)*dx + np.sin(self.theta)*dy)/self.xstep + (self.ncols-1)/2.
+        v = (-np.sin(self.theta)*dx + np.cos(self.theta)*dy)/self.ystep + (self.nrows-1)/2.
+        valid = np.isfinite(u) & np.isfinite(v)
+        col = np.clip(np.rint(np.where(valid, u, 0.)), 0, self.ncols-1).astype(int)
+        row = np.clip(np.rint(np.where(valid, v, 0.)), 0, self.nrows-1).astype(int)
+
+        ## Check neighboring grid sources if distorted
+        if np.any(self.norm_dy != 0.) or np.any(self.norm_dx != 0.):
+            offsets = np.arange(-1, 2)
+            cols = np.clip(col[:, None, None] + offsets[None, :, None], 0, self.ncols-1)
+            rows = np.clip(row[:, None, None] + offsets[None, None, :], 0, self.nrows-1)
+            candidates = (cols*self.nrows + rows).reshape(-1, 9)
+            dist2 = (y[:, None] - gY[candidates])**2 + (x[:, None] - gX[candidates])**2
+            index = candidates[np.arange(candidates.shape[0]), np.argmin(dist2, axis=1)]
+
+            ## Search all grid sources for positions far outside the grid
+            far = valid & (np.min(dist2, axis=1) > max(self.xstep, self.ystep)**2)
+            if np.any(far):
+                nn_indices, nn_distances = nearest_neighbors(y[far], x[far], gY, gX)
+                index[far] = nn_indices[:, 0]
+        else:
+            index = col*self.nrows + row
+
+        res_y = np.where(valid, y - gY[index], np.nan)
+        res_x = np.where(valid, x - gX[index], np.nan)
+        index = np.where(valid, index, -1)
+
+        return index, res_y, res_x
 
     def write_fits(self, outfile, **kwargs):
         """Write DistortedGrid instance to a FITS file."""
@@ -183,23 +256,44 @@ def coordinate_distances(y0, x0, y1, x1, metric='euclidean'):
     
     return indices, distances
 
-def fit_error(params, srcY, srcX, nrows, ncols, normalized_shifts=None, 
-              ccd_geom=None):
-    """Calculate sum of positional errors of true source grid and model grid.
-    
-    For every true source, the distance to the nearest neighbor source 
-    from a model source grid is calculated.  The mean for every true source
-    is taken as the fit error between true source grid and model grid.
-       
+def nearest_neighbors(y0, x0, y1, x1, k=1, distance_upper_bound=np.inf):
+    """Find the nearest neighbors in a second set of points using a KD-tree.
+
+    Args:
+        y0 (numpy.ndarray): Array of query point y-positions.
+        x0 (numpy.ndarray): Array of query point x-positions.
+        y1 (numpy.ndarray): Array of neighbor point y-positions.
+        x1 (numpy.ndarray): Array of neighbor point x-positions.
+        k (int): Number of nearest neighbors.
+        distance_upper_bound (float): Maximum neighbor distance.
+
+    Returns:
+        Tuple of (N, k) arrays of neighbor indices and distances, sorted by
+        distance.  Missing neighbors have index equal to the number of
+        neighbor points and infinite distance.
+    """
+    tree = cKDTree(np.stack([y1, x1], axis=1))
+    distances, indices = tree.query(np.stack([y0, x0], axis=1), k=k,
+                                    distance_upper_bound=distance_upper_bound)
+
+    return indices.reshape(-1, k), distances.reshape(-1, k)
+
+def locate_sources(params, srcY, srcX, nrows, ncols, normalized_shifts=None, 
+                   ccd_geom=None, grid=None):
+    """Find the nearest model grid source for each true source.
+
     Args:
         params (list): List of grid parameters.
         srcY (numpy.ndarray): Array of source y-positions.
         srcX (numpy.ndarray): Array of source x-positions.
         nrows (int): Number of grid rows.
         ncols (int): Number of grid columns.
-        
+        grid (DistortedGrid): Optional grid model to update with the 
+            parameters, reused between evaluations.
+
     Returns:
-        Float representing sum of nearest neighbor distances.
+        Tuple of grid model, and arrays of grid source indices and y/x 
+        residuals.
     """
     
     ## Fit parameters
@@ -210,10 +304,13 @@ def fit_error(params, srcY, srcX, nrows, ncols, normalized_shifts=None,
     y0 = parvals['y0']
     x0 = parvals['x0']
     
-    ## Create grid model and construct x/y coordinate arrays
-    grid = DistortedGrid(ystep, xstep, theta, y0, x0, ncols, nrows,
-                         normalized_shifts=normalized_shifts)    
-    gY, gX = grid.get_source_centroids()
+    ## Create or update grid model and find nearest grid source
+    if grid is None:
+        grid = DistortedGrid(ystep, xstep, theta, y0, x0, ncols, nrows,
+                             normalized_shifts=normalized_shifts)    
+    else:
+        grid.set_params(ystep, xstep, theta, y0, x0)
+    indices, dy, dx = grid.locate(srcY, srcX)
 
     ## Filter source grid positions according to CCD geometry
     if ccd_geom is not None:
@@ -222,58 +319,233 @@ def fit_error(params, srcY, srcX, nrows, ncols, normalized_shifts=None,
         xmin = 0 
         xmax = ccd_geom.nx*8
 
+        gY, gX = grid.get_source_centroids(out=grid._centroids)
         mask = (gY < ymax)*(gY > ymin)*(gX < xmax)*(gX > xmin)
-        gY = gY[mask]
-        gX = gX[mask]
 
-    ## Calculate residuals   
-    indices, distances = coordinate_distances(srcY, srcX, gY, gX)
+        ## Search remaining grid sources if nearest is filtered
+        outside = (indices >= 0) & ~mask[indices]
+        if np.any(outside) and np.any(mask):
+            nn_indices, nn_distances = nearest_neighbors(srcY[outside], srcX[outside], 
+                                                         gY[mask], gX[mask])
+            indices[outside] = np.flatnonzero(mask)[nn_indices[:, 0]]
+            dy[outside] = srcY[outside] - gY[indices[outside]]
+            dx[outside] = srcX[outside] - gX[indices[outside]]
 
-    return distances[:, 0]
+    return grid, indices, dy, dx
 
-def grid_fit(srcY, srcX, y0_guess, x0_guess, ncols, nrows, brute_search=False, 
-             vary_theta=False, method='least_squares', normalized_shifts=None, 
-             ccd_geom=None):
+def fit_error(params, srcY, srcX, nrows, ncols, normalized_shifts=None, 
+              ccd_geom=None, grid=None):
+    """Calculate sum of positional errors of true source grid and model grid.
+    
+    For every true source, the distance to the nearest neighbor source 
+    from a model source grid is calculated.  The mean for every true source
+    is taken as the fit error between true source grid and model grid.
+       
+    Args:
+        params (list): List of grid parameters.
+        srcY (numpy.ndarray): Array of source y-positions.
+        srcX (numpy.ndarray): Array of source x-positions.
+        nrows (int): Number of grid rows.
+        ncols (int): Number of grid columns.
+        grid (DistortedGrid): Optional grid model to update with the 
+            parameters, reused between evaluations.
+        
+    Returns:
+        Float representing sum of nearest neighbor distances.
+    """
+    grid, indices, dy, dx = locate_sources(params, srcY, srcX, nrows, ncols,
+                                           normalized_shifts=normalized_shifts,
+                                           ccd_geom=ccd_geom, grid=grid)
 
-    ## Calculate mean xstep/ystep
-    nsources = srcY.shape[0]
-    indices, distances = coordinate_distances(srcY, srcX, srcY, srcX)
+    return np.hypot(dy, dx)
+
+def fit_jacobian(params, srcY, srcX, nrows, ncols, normalized_shifts=None,
+                 ccd_geom=None, grid=None):
+    """Calculate the Jacobian of the positional errors for the varied parameters.
+
+    Nearest neighbor assignments are held fixed, so the derivatives of each
+    distance with respect to the grid parameters are analytic.  Rows for
+    non-finite distances are omitted, matching a ``nan_policy`` of 'omit'.
+
+    Args:
+        params (list): List of grid parameters.
+        srcY (numpy.ndarray): Array of source y-positions.
+        srcX (numpy.ndarray): Array of source x-positions.
+        nrows (int): Number of grid rows.
+        ncols (int): Number of grid columns.
+        grid (DistortedGrid): Optional grid model to update with the 
+            parameters, reused between evaluations.
+
+    Returns:
+        Array of distance derivatives with a column for each varied 
+        parameter.
+    """
+    grid, indices, dy, dx = locate_sources(params, srcY, srcX, nrows, ncols,
+                                           normalized_shifts=normalized_shifts,
+                                           ccd_geom=ccd_geom, grid=grid)
+    distances = np.hypot(dy, dx)
+    valid = np.isfinite(distances)
+    indices = indices[valid]
+    dy = dy[valid]
+    dx = dx[valid]
+    distances = distances[valid]
+
+    ## Grid source offsets from grid center in units of grid steps
+    u = grid._distorted_basis[0, indices]
+    v = grid._distorted_basis[1, indices]
+    cos = np.cos(grid.theta)
+    sin = np.sin(grid.theta)
+    gy = sin*grid.xstep*u + cos*grid.ystep*v
+    gx = cos*grid.xstep*u - sin*grid.ystep*v
+
+    ## Derivatives of grid source y/x-positions
+    derivatives = {'y0' : (1., 0.), 'x0' : (0., 1.), 'theta' : (gx, -gy),
+                   'xstep' : (sin*u, cos*u), 'ystep' : (cos*v, -sin*v)}
+    scale = np.zeros(distances.shape[0])
+    np.divide(-1., distances, out=scale, where=distances > 0.)
+
+    columns = [scale*(dy*derivatives[name][0] + dx*derivatives[name][1]) 
+               for name, par in params.items() if par.vary]
+
+    return np.stack(columns, axis=1)
+
+def estimate_grid_lattice(srcY, srcX, max_deviation=10.):
+    """Estimate the grid steps and rotation from nearest neighbor offsets.
+
+    The offsets of each source to its four nearest neighbors are used, 
+    excluding those with lengths differing from the median by more than 
+    ``max_deviation``.  The grid rotation is the four-fold circular mean of 
+    the offset angles, refined by the median angle residual, and the steps 
+    are the median offset lengths along each grid axis.
+
+    Args:
+        srcY (numpy.ndarray): Array of source y-positions.
+        srcX (numpy.ndarray): Array of source x-positions.
+        max_deviation (float): Maximum deviation of offset length from 
+            median offset length.
+
+    Returns:
+        Tuple of ystep, xstep, theta and confidence (four-fold resultant 
+        length of offset angles, from 0 for no lattice to 1 for a perfect 
+        lattice).
+    """
+    indices, distances = nearest_neighbors(srcY, srcX, srcY, srcX, k=5)
     nn_indices = indices[:, 1:5]
     nn_distances = distances[:, 1:5]
-    med_dist = np.median(nn_distances)
-
-    dist1_array = np.full(nsources, np.nan)
-    dist2_array = np.full(nsources, np.nan)
-    theta_array = np.full(nsources, np.nan)
 
-    for i in range(nsources):
+    ## Neighbor offsets with length near median
+    valid = np.isfinite(nn_distances)
+    valid[valid] = np.abs(nn_distances[valid] - np.median(nn_distances[valid])) <= max_deviation
+    nn_dy = srcY[nn_indices[valid]] - np.repeat(srcY, 4).reshape(-1, 4)[valid]
+    nn_dx = srcX[nn_indices[valid]] - np.repeat(srcX, 4).reshape(-1, 4)[valid]
+    nn_distances = nn_distances[valid]
+    if nn_distances.shape[0] == 0:
+        return np.nan, np.nan, np.nan, 0.
+
+    ## Four-fold circular mean of offset angles
+    angles = np.arctan2(nn_dy, nn_dx)
+    resultant = np.mean(np.exp(4j*angles))
+    confidence = np.abs(resultant)
+    theta = np.angle(resultant)/4.
+
+    ## Refine with median angle residual, in range [-pi/4, pi/4)
+    residuals = np.mod(angles - theta + np.pi/4., np.pi/2.) - np.pi/4.
+    theta = np.mod(theta + np.median(residuals) + np.pi/4., np.pi/2.) - np.pi/4.
+
+    ## Median offset lengths along each grid axis
+    residuals = np.mod(angles - theta + np.pi/4., np.pi) - np.pi/4.
+    along_x = residuals < np.pi/4.
+    xstep = np.median(nn_distances[along_x]) if np.any(along_x) else np.nan
+    ystep = np.median(nn_distances[~along_x]) if np.any(~along_x) else np.nan
+
+    return ystep, xstep, theta, confidence
+
+def brute_search_grid(srcY, srcX, grid, y0_values, x0_values, theta_values=None,
+                      ccd_geom=None, chunk_size=1000000):
+    """Score grid center and rotation candidates in a vectorized pass.
+
+    For each candidate, every source is assigned to the nearest of the 3x3 
+    grid sources around its rounded grid row and column, and the score is 
+    the sum of squared distances, each truncated at the larger grid step 
+    so that sources outside the grid do not dominate.
 
-        yc = srcY[i]
-        xc = srcX[i]
+    Args:
+        srcY (numpy.ndarray): Array of source y-positions.
+        srcX (numpy.ndarray): Array of source x-positions.
+        grid (DistortedGrid): Grid model with steps and centroid shifts.
+        y0_values (numpy.ndarray): Candidate grid center y-positions.
+        x0_values (numpy.ndarray): Candidate grid center x-positions.
+        theta_values (numpy.ndarray): Optional candidate grid rotations; 
+            the grid rotation is used if `None`.
+        chunk_size (int): Maximum number of candidate-source pairs 
+            evaluated at once.
 
-        for j in range(4):
+    Returns:
+        Tuple of best y0, x0, theta and array of scores with shape 
+        (len(y0_values), len(x0_values), len(theta_values)).
+    """
+    if theta_values is None:
+        theta_values = [grid.theta]
+    valid = np.isfinite(srcY) & np.isfinite(srcX)
+    srcY = np.asarray(srcY, dtype=float)[valid]
+    srcX = np.asarray(srcX, dtype=float)[valid]
+    y0, x0, theta = [a.ravel() for a in np.meshgrid(y0_values, x0_values, theta_values, 
+                                                    indexing='ij')]
+
+    nrows, ncols = grid.nrows, grid.ncols
+    xstep, ystep = grid.xstep, grid.ystep
+    max_dist2 = max(xstep, ystep)**2
+    scores = np.empty(y0.shape[0])
+    step = max(1, chunk_size//max(srcY.shape[0], 1))
+    for start in range(0, y0.shape[0], step):
+        cy0 = y0[start:start+step, None]
+        cx0 = x0[start:start+step, None]
+        cos = np.cos(theta[start:start+step, None])
+        sin = np.sin(theta[start:start+step, None])
+
+        ## Nearest row and column of ideal grid
+        dy = srcY - cy0
+        dx = srcX - cx0
+        col = np.rint((cos*dx + sin*dy)/xstep + (ncols-1)/2.).astype(int)
+        row = np.rint((-sin*dx + cos*dy)/ystep + (nrows-1)/2.).astype(int)
+
+        ## Nearest of neighboring distorted grid sources
+        dist2 = np.full(dy.shape, max_dist2)
+        for col_offset, row_offset in product(range(-1, 2), range(-1, 2)):
+            index = np.clip(col+col_offset, 0, ncols-1)*nrows + np.clip(row+row_offset, 0, nrows-1)
+            u = grid._distorted_basis[0, index]
+            v = grid._distorted_basis[1, index]
+            gy = sin*xstep*u + cos*ystep*v
+            gx = cos*xstep*u - sin*ystep*v
+            d2 = (dy - gy)**2 + (dx - gx)**2
+            if ccd_geom is not None:
+                gy += cy0
+                gx += cx0
+                d2[(gy >= ccd_geom.ny*2) | (gy <= 0) | (gx >= ccd_geom.nx*8) | (gx <= 0)] = np.inf
+            np.minimum(dist2, d2, out=dist2)
+        scores[start:start+step] = np.sum(dist2, axis=1)
+
+    best = np.argmin(scores)
+    scores = scores.reshape(len(y0_values), len(x0_values), len(theta_values))
+
+    return y0[best], x0[best], theta[best], scores
 
-            nn_dist = nn_distances[i, j]
-            if np.abs(nn_dist - med_dist) > 10.: continue
-            y_nn = srcY[nn_indices[i, j]]
-            x_nn = srcX[nn_indices[i, j]]
+def grid_fit(srcY, srcX, y0_guess, x0_guess, ncols, nrows, brute_search=False, 
+             vary_theta=False, method='least_squares', normalized_shifts=None, 
+             ccd_geom=None, analytic_jacobian=True, vary_steps=False, lattice=None, 
+             min_confidence=0.9):
 
-            if x_nn > xc:
-                if y_nn > yc:
-                    dist1_array[i] = nn_dist
-                    theta_array[i] = np.arctan((y_nn-yc)/(x_nn-xc))
-                else:
-                    dist2_array[i] = nn_dist
+    ## Estimate grid lattice from nearest neighbors
+    ystep, xstep, theta, confidence = estimate_grid_lattice(srcY, srcX)
 
-    ## Use theta to determine x/y step direction
-    theta = np.nanmedian(theta_array)
-    if theta >= np.pi/4.:
-        theta = theta - (np.pi/2.)
-        xstep = np.nanmedian(dist2_array)
-        ystep = np.nanmedian(dist1_array)
-    else:
-        xstep = np.nanmedian(dist1_array)
-        ystep = np.nanmedian(dist2_array)
+    ## Seed grid step fit from lattice (e.g. warm start) if estimate is confident and agrees
+    seed_ystep, seed_xstep = ystep, xstep
+    warm_start = False
+    if vary_steps and lattice is not None and confidence >= min_confidence:
+        shift = max(abs(lattice[0]-ystep)*(nrows-1)/2., abs(lattice[1]-xstep)*(ncols-1)/2.)
+        if shift <= min(ystep, xstep)/3.:
+            seed_ystep, seed_xstep = lattice[:2]
+            warm_start = True
 
     ## Define fit parameters
     params = Parameters()
@@ -281,31 +553,401 @@ def grid_fit(srcY, srcX, y0_guess, x0_guess, ncols, nrows, brute_search=False,
     params.add('xstep', value=xstep, vary=False)
     params.add('theta', value=theta, vary=False)
 
+    ## Grid model updated by each fit evaluation
+    grid = DistortedGrid(ystep, xstep, theta, y0_guess, x0_guess, ncols, nrows,
+                         normalized_shifts=normalized_shifts)
+
     ## Optionally perform initial brute search
     params.add('y0', value=y0_guess, min=y0_guess-ystep/3., max=y0_guess+ystep/3., 
                vary=True, brute_step=ystep/6.)
     params.add('x0', value=x0_guess, min=x0_guess-xstep/3., max=x0_guess+xstep/3., 
                vary=True, brute_step=xstep/6.)
     if brute_search:
-        minner = Minimizer(fit_error, params, fcn_args=(srcY, srcX, ncols, nrows),
-                           fcn_kws={'normalized_shifts' : normalized_shifts,
-                                    'ccd_geom' : ccd_geom},
-                           nan_policy='omit')
-        result = minner.minimize(method='brute', params=params)
+        y0_values = np.arange(params['y0'].min, params['y0'].max + ystep/12., ystep/6.)
+        x0_values = np.arange(params['x0'].min, params['x0'].max + xstep/12., xstep/6.)
+        theta_values = theta + np.arange(-5, 6)*np.pi/180. if vary_theta else None
+        y0, x0, theta_best, scores = brute_search_grid(srcY, srcX, grid, y0_values, x0_values,
+                                                       theta_values=theta_values, 
+                                                       ccd_geom=ccd_geom)
+        params['theta'].set(value=theta_best)
+        params['y0'].set(value=y0, min=y0-ystep/3., max=y0+ystep/3.)
+        params['x0'].set(value=x0, min=x0-xstep/3., max=x0+xstep/3.)
+
+    ## LM Fit
+    minner = Minimizer(fit_error, params, fcn_args=(srcY, srcX, ncols, nrows),
+                       fcn_kws={'ccd_geom' : ccd_geom, 'grid' : grid},
+                       nan_policy='omit')
+    def minimize(params):
+        if analytic_jacobian and method == 'least_squares':
+            return minner.minimize(params=params, method=method, max_nfev=400, jac=fit_jacobian)
+        return minner.minimize(params=params, method=method, max_nfev=400)
+
+    ## Optionally fit grid steps with fixed rotation, before any rotation fit
+    if vary_steps:
+        params['ystep'].set(value=seed_ystep, min=seed_ystep-ystep/(nrows-1), 
+                            max=seed_ystep+ystep/(nrows-1), vary=True)
+        params['xstep'].set(value=seed_xstep, min=seed_xstep-xstep/(ncols-1), 
+                            max=seed_xstep+xstep/(ncols-1), vary=True)
+        result = minimize(params)
         params = result.params
-        parvals = params.valuesdict()
-        params['y0'].set(min=parvals['y0']-ystep/3., max=parvals['y0']+ystep/3.)
-        params['x0'].set(min=parvals['x0']-xstep/3., max=parvals['x0']+xstep/3.)
+        params['ystep'].set(vary=False)
+        params['xstep'].set(vary=False)
 
     ## Optionally enable parameter fit to theta
     if vary_theta:
         params['theta'].set(vary=True, min=theta-5*np.pi/180., max=theta+5*np.pi/180.)
-
-    ## LM Fit
-    minner = Minimizer(fit_error, params, fcn_args=(srcY, srcX, ncols, nrows),
-                       fcn_kws={'normalized_shifts' : normalized_shifts,
-                                'ccd_geom' : ccd_geom},
-                       nan_policy='omit')
-    result = minner.minimize(params=params, method=method, max_nfev=400)
+        nfev = result.nfev if vary_steps else 0
+        result = minimize(params)
+        result.nfev += nfev
+    elif not vary_steps:
+        result = minimize(params)
+    result.lattice_confidence = confidence
+    result.warm_start = warm_start
 
     return result
+
+## Byte width and numpy type of FITS binary table column formats
+FITS_FORMATS = {'L' : (1, None), 'X' : (1, None), 'B' : (1, 'u1'), 'I' : (2, '>i2'), 
+                'J' : (4, '>i4'), 'K' : (8, '>i8'), 'A' : (1, None), 'E' : (4, '>f4'), 
+                'D' : (8, '>f8'), 'C' : (8, '>c8'), 'M' : (16, '>c16'), 'P' : (8, None), 
+                'Q' : (16, None)}
+
+def read_catalog_columns(infile, names, ext=1):
+    """Read selected columns of a FITS binary table.
+
+    Column offsets are found from the table header and the table data are
+    memory-mapped, so only the selected columns are converted instead of 
+    the full table.  Column names are matched case-insensitively, as in 
+    astropy.  Columns that are not plain numeric (e.g. bits, strings or 
+    variable-length arrays) or that are scaled are read with astropy.
+
+    Args:
+        infile (str): FITS filename.
+        names (list): Column names.
+        ext (int or str): Table extension.
+
+    Returns:
+        Dictionary of column arrays, keyed by the given names.
+    """
+    names = list(dict.fromkeys(names))
+    columns = {}
+    with fits.open(infile, memmap=True) as hdulist:
+
+        header = hdulist[ext].header
+        data_offset = hdulist[ext].fileinfo()['datLoc']
+        nrows = header['NAXIS2']
+
+        ## Find byte offsets of numeric columns
+        fields = {}
+        offset = 0
+        for i in range(1, header['TFIELDS']+1):
+            repeat, code = re.match(r'(\d*)([A-Z])', header['TFORM{0}'.format(i)].strip()).groups()
+            repeat = int(repeat) if repeat else 1
+            width, dtype = FITS_FORMATS[code]
+            if code == 'X':
+                nbytes = (repeat + 7)//8
+            elif code in ('P', 'Q'):
+                nbytes = width
+            else:
+                nbytes = width*repeat
+            scaled = any('{0}{1}'.format(key, i) in header for key in ('TSCAL', 'TZERO', 'TDIM'))
+            if (dtype is not None) and (repeat > 0) and not scaled:
+                fields[header['TTYPE{0}'.format(i)].lower()] = (dtype if repeat == 1 else (dtype, (repeat,)), 
+                                                                offset)
+            offset += nbytes
+
+        selected = [name for name in names if name.lower() in fields]
+        if len(selected) > 0 and nrows > 0:
+            dtype = np.dtype({'names' : selected, 
+                              'formats' : [fields[name.lower()][0] for name in selected],
+                              'offsets' : [fields[name.lower()][1] for name in selected],
+                              'itemsize' : header['NAXIS1']})
+            table = np.memmap(infile, dtype=dtype, mode='r', offset=data_offset, shape=(nrows,))
+            for name in selected:
+                columns[name] = table[name].astype(table[name].dtype.newbyteorder('='))
+            del table
+
+        ## Remaining columns
+        for name in names:
+            if name not in columns:
+                columns[name] = np.array(hdulist[ext].data.field(name))
+
+    return columns
+
+def read_gridfit_catalog(infile, y_kwd='base_SdssCentroid_Y', x_kwd='base_SdssCentroid_X'):
+    """Read source positions and matched grid sources of a grid fit catalog.
+
+    Grid fit catalogs written by GridFitTask have the matched grid source
+    columns in the source table, or in a SPOTGRID table (appended to the 
+    source catalog, or in a side-car file that names the source catalog 
+    with the SRCFILE keyword).
+
+    Args:
+        infile (str): Grid fit catalog filename.
+        y_kwd (str): Source catalog y-position keyword.
+        x_kwd (str): Source catalog x-position keyword.
+
+    Returns:
+        Tuple of arrays of source y-positions, x-positions, grid source 
+        indices (NaN if unmatched), grid source y-positions and x-positions.
+    """
+    with fits.open(infile, memmap=True) as hdulist:
+        spotgrid_ext = 'SPOTGRID' if 'SPOTGRID' in hdulist else 1
+        srcfile = hdulist[0].header.get('SRCFILE', None)
+
+    if srcfile is not None and not os.path.isabs(srcfile):
+        srcfile = os.path.join(os.path.dirname(infile), srcfile)
+    elif srcfile is None:
+        srcfile = infile
+
+    spotgrid = read_catalog_columns(infile, ['spotgrid_index', 'spotgrid_y', 'spotgrid_x'], 
+                                    ext=spotgrid_ext)
+    sources = read_catalog_columns(srcfile, [y_kwd, x_kwd])
+
+    return (sources[y_kwd].astype(float), sources[x_kwd].astype(float), 
+            spotgrid['spotgrid_index'].astype(float), spotgrid['spotgrid_y'].astype(float), 
+            spotgrid['spotgrid_x'].astype(float))
+
+def histogram_quantile(hist, q, lower, bin_width):
+    """Calculate quantiles from histograms, interpolating within bins.
+
+    Args:
+        hist (numpy.ndarray): (N, nbins) array of histogram counts.
+        q (float): Quantile.
+        lower (float): Lower edge of the first bin.
+        bin_width (float): Width of the bins.
+
+    Returns:
+        Array of quantiles for each histogram (NaN for empty histograms).
+    """
+    cumulative = np.cumsum(hist, axis=1)
+    target = q*cumulative[:, -1]
+    i = np.argmax(cumulative >= target[:, None], axis=1)
+    rows = np.arange(hist.shape[0])
+    below = cumulative[rows, i] - hist[rows, i]
+    fraction = np.zeros(hist.shape[0])
+    np.divide(target - below, hist[rows, i], out=fraction, where=hist[rows, i] > 0)
+    quantile = lower + (i + fraction)*bin_width
+
+    return np.where(cumulative[:, -1] > 0, quantile, np.nan)
+
+class OpticsGridBuilder:
+    """Streaming estimator of normalized centroid shifts from grid fits.
+
+    Each grid fit catalog is read in turn and its matched source residuals
+    are rotated and normalized by its fitted grid, and added to the 
+    normalized shifts already used in that fit.  Per grid source, these are
+    accumulated as an online mean and variance and as a fixed-width 
+    histogram, from which the median and a robust (interquartile) scatter
+    are calculated.  Residuals larger than ``max_shift`` grid steps are 
+    rejected as mismatches.
+
+    Args:
+        ncols (int): Number of grid columns.
+        nrows (int): Number of grid rows.
+        max_shift (float): Maximum normalized shift.
+        bin_width (float): Histogram bin width, in units of grid steps.
+    """
+
+    def __init__(self, ncols=49, nrows=49, max_shift=0.25, bin_width=5.E-4):
+
+        self.ncols = ncols
+        self.nrows = nrows
+        self.max_shift = max_shift
+        self.bin_width = bin_width
+        self.nbins = int(np.ceil(2*max_shift/bin_width))
+
+        nsources = ncols*nrows
+        self.count = np.zeros(nsources, dtype=np.int64)
+        self._mean = np.zeros((2, nsources))
+        self._m2 = np.zeros((2, nsources))
+        self._hist = np.zeros((2, nsources, self.nbins), dtype=np.int64)
+
+        ## Running sums of grid parameters
+        self.ncatalogs = 0
+        self._param_sums = np.zeros(3)
+
+    def add_shifts(self, indices, norm_dy, norm_dx):
+        """Accumulate normalized shifts for grid sources.
+
+        Args:
+            indices (numpy.ndarray): Array of grid source indices.
+            norm_dy (numpy.ndarray): Array of normalized y-shifts.
+            norm_dx (numpy.ndarray): Array of normalized x-shifts.
+        """
+        nsources = self.ncols*self.nrows
+        shifts = np.stack([norm_dy, norm_dx]).astype(float)
+        indices = np.asarray(indices)
+        mask = (indices >= 0) & (indices < nsources) & np.all(np.isfinite(shifts), axis=0) \
+            & np.all(np.abs(shifts) < self.max_shift, axis=0)
+        indices = indices[mask].astype(int)
+        shifts = shifts[:, mask]
+
+        ## Combine batch mean and variance with running values
+        n_b = np.bincount(indices, minlength=nsources)
+        n = self.count + n_b
+        has_new = n_b > 0
+        for i in range(2):
+            mean_b = np.zeros(nsources)
+            np.divide(np.bincount(indices, weights=shifts[i], minlength=nsources), n_b, 
+                      out=mean_b, where=has_new)
+            m2_b = np.bincount(indices, weights=(shifts[i] - mean_b[indices])**2, 
+                               minlength=nsources)
+            delta = mean_b - self._mean[i]
+            self._mean[i] = np.where(has_new, self._mean[i] + delta*n_b/np.maximum(n, 1), 
+                                     self._mean[i])
+            self._m2[i] += m2_b + delta**2*self.count*n_b/np.maximum(n, 1)
+
+            ## Histogram for robust statistics
+            bins = np.clip(((shifts[i] + self.max_shift)/self.bin_width).astype(int), 
+                           0, self.nbins-1)
+            self._hist[i] += np.bincount(indices*self.nbins + bins, 
+                                         minlength=nsources*self.nbins).reshape(nsources, self.nbins)
+        self.count = n
+
+    def add_catalog(self, infile, y_kwd='base_SdssCentroid_Y', x_kwd='base_SdssCentroid_X'):
+        """Accumulate normalized shifts from a grid fit catalog.
+
+        Args:
+            infile (str): Catalog written by GridFitTask, with matched
+                grid source columns and GRID_INFO HDU (see 
+                read_gridfit_catalog).
+            y_kwd (str): Source catalog y-position keyword.
+            x_kwd (str): Source catalog x-position keyword.
+        """
+        grid = DistortedGrid.from_fits(infile)
+        if (grid.ncols != self.ncols) or (grid.nrows != self.nrows):
+            raise ValueError('{0} grid shape ({1}, {2}) does not match ({3}, {4})'.format(
+                infile, grid.ncols, grid.nrows, self.ncols, self.nrows))
+
+        srcY, srcX, grid_index, grid_y, grid_x = read_gridfit_catalog(infile, y_kwd=y_kwd, 
+                                                                      x_kwd=x_kwd)
+
+        matched = np.isfinite(grid_index)
+        indices = grid_index[matched].astype(int)
+        dy = srcY[matched] - grid_y[matched]
+        dx = srcX[matched] - grid_x[matched]
+
+        ## Rotate and normalize residuals, adding shifts used in fit
+        norm_dx = (np.cos(-grid.theta)*dx - np.sin(-grid.theta)*dy)/grid.xstep
+        norm_dy = (np.sin(-grid.theta)*dx + np.cos(-grid.theta)*dy)/grid.ystep
+        self.add_shifts(indices, norm_dy + grid.norm_dy[indices], 
+                        norm_dx + grid.norm_dx[indices])
+
+        self.ncatalogs += 1
+        self._param_sums += (grid.ystep, grid.xstep, grid.theta)
+
+    @property
+    def mean(self):
+        """Tuple of arrays of mean normalized y-shifts and x-shifts."""
+        mean = np.where(self.count > 0, self._mean, np.nan)
+        return mean[0], mean[1]
+
+    @property
+    def std(self):
+        """Tuple of arrays of standard deviation of normalized y-shifts and x-shifts."""
+        var = np.full(self._m2.shape, np.nan)
+        np.divide(self._m2, self.count - 1, out=var, where=self.count > 1)
+        return np.sqrt(var[0]), np.sqrt(var[1])
+
+    @property
+    def median(self):
+        """Tuple of arrays of median normalized y-shifts and x-shifts."""
+        return tuple(histogram_quantile(self._hist[i], 0.5, -self.max_shift, self.bin_width)
+                     for i in range(2))
+
+    @property
+    def robust_std(self):
+        """Tuple of arrays of interquartile scatter of normalized y-shifts and x-shifts."""
+        scatter = []
+        for i in range(2):
+            q25 = histogram_quantile(self._hist[i], 0.25, -self.max_shift, self.bin_width)
+            q75 = histogram_quantile(self._hist[i], 0.75, -self.max_shift, self.bin_width)
+            scatter.append((q75 - q25)/1.349)
+        return tuple(scatter)
+
+    def make_grid(self, min_count=3):
+        """Create a grid with the median normalized shifts.
+
+        The mean shift over all grid sources is removed, as it is degenerate
+        with the grid center.  Grid sources with fewer than ``min_count`` 
+        shifts are given no shift.
+
+        Args:
+            min_count (int): Minimum number of shifts for a grid source.
+
+        Returns:
+            DistortedGrid with mean grid steps and rotation, centered at
+            the origin.
+        """
+        if self.ncatalogs == 0:
+            raise ValueError('No catalogs have been added.')
+        ystep, xstep, theta = self._param_sums/self.ncatalogs
+
+        good = self.count >= min_count
+        normalized_shifts = []
+        for shift in self.median:
+            shift = np.where(good, shift, 0.)
+            if np.any(good):
+                shift[good] -= np.mean(shift[good])
+            normalized_shifts.append(shift)
+
+        return DistortedGrid(ystep, xstep, theta, 0., 0., self.ncols, self.nrows,
+                             normalized_shifts=tuple(normalized_shifts))
+
+    def write_fits(self, outfile, min_count=3, **kwargs):
+        """Write the grid and shift statistics to a FITS file.
+
+        Args:
+            outfile (str): Output filename.
+            min_count (int): Minimum number of shifts for a grid source.
+
+        Returns:
+            DistortedGrid written to the GRID_INFO HDU.
+        """
+        grid = self.make_grid(min_count=min_count)
+        grid_hdu = grid.make_grid_hdu()
+
+        ## Add shift statistics for each grid source
+        mean_dy, mean_dx = self.mean
+        robust_std_dy, robust_std_dx = self.robust_std
+        cols = [fits.Column('NSHIFTS', array=self.count, format='K'),
+                fits.Column('MEAN_DY', array=mean_dy, format='D'),
+                fits.Column('MEAN_DX', array=mean_dx, format='D'),
+                fits.Column('ROBUST_STD_DY', array=robust_std_dy, format='D'),
+                fits.Column('ROBUST_STD_DX', array=robust_std_dx, format='D')]
+        tablehdu = fits.BinTableHDU.from_columns(grid_hdu.columns + fits.ColDefs(cols),
+                                                 header=grid_hdu.header, name='GRID_INFO')
+        tablehdu.header['NCATALOG'] = self.ncatalogs
+        tablehdu.header['MINCOUNT'] = min_count
+
+        hdulist = fits.HDUList([fits.PrimaryHDU(), tablehdu])
+        hdulist.writeto(outfile, **kwargs)
+
+        return grid
+
+def build_optics_grid(infiles, outfile=None, ncols=49, nrows=49, min_count=3,
+                      y_kwd='base_SdssCentroid_Y', x_kwd='base_SdssCentroid_X', **kwargs):
+    """Build a grid of normalized centroid shifts from grid fit catalogs.
+
+    Args:
+        infiles (list): Catalogs written by GridFitTask.
+        outfile (str): Optional output FITS filename.
+        ncols (int): Number of grid columns.
+        nrows (int): Number of grid rows.
+        min_count (int): Minimum number of shifts for a grid source.
+        **kwargs: Keyword arguments for OpticsGridBuilder.
+
+    Returns:
+        Tuple of DistortedGrid and OpticsGridBuilder.
+    """
+    builder = OpticsGridBuilder(ncols=ncols, nrows=nrows, **kwargs)
+    for infile in infiles:
+        builder.add_catalog(infile, y_kwd=y_kwd, x_kwd=x_kwd)
+
+    if outfile is not None:
+        grid = builder.write_fits(outfile, min_count=min_count, overwrite=True)
+    else:
+        grid = builder.make_grid(min_count=min_count)
+
+    return grid, builder
@@ -4,15 +4,21 @@ To Do:
     * Fix AMP2SEG and SEG2AMP definitions.
 """
 from astropy.io import fits
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import numpy as np
 import ipywidgets as widgets
 
 import lsst.afw.math as afwMath
+import lsst.afw.image as afwImage
 import lsst.eotest.image_utils as imutils
 from lsst.eotest.sensor.MaskedCCD import MaskedCCD
 from lsst.eotest.sensor.AmplifierGeometry import AmplifierGeometry, amp_loc
 
+from mixcoatl.database import query_summary
+
 ITL_AMP_GEOM = AmplifierGeometry(prescan=3, nx=509, ny=2000, 
                                  detxsize=4608, detysize=4096,
                                  amp_loc=amp_loc['ITL'], vendor='ITL')
@@ -31,16 +37,291 @@ SEG2AMP = {'C00' : 16, 'C01' : 15, 'C02' : 14, 'C03' : 13, 'C04' : 12, 'C05' : 1
            'C10' : 1, 'C11' : 2, 'C12' : 3, 'C13' : 4, 'C14' : 5, 'C15' : 6, 'C16' : 7, 'C17' : 8}
 """dict: Dictionary mapping from CCD segment names to amplifier number."""
 
+class AmpImageCache():
+    """Memory-bounded cache of calibrated and stacked amplifier images.
+
+    Each bias-subtracted, trimmed and stacked amplifier pixel array is built
+    once on first access and kept, keyed by the input files and amplifier,
+    until the memory budget is exceeded and the least recently used arrays
+    are evicted.  Cached arrays are read-only.
+
+    Parameters
+    ----------
+    infiles : `list`
+        Input image FITS files.
+    ccds : `list` of `lsst.eotest.sensor.MaskedCCD`
+        Calibrated CCD images for each input file.
+    max_size : `float`
+        Memory budget (MB) for cached amplifier pixel arrays.
+    """
+
+    def __init__(self, infiles, ccds, max_size=1024.):
+
+        self.infiles = tuple(infiles)
+        self.ccds = ccds
+        self.max_size = max_size
+        self.nbytes = 0
+        self._cache = OrderedDict()
+
+    def __getitem__(self, amp):
+
+        key = (self.infiles, amp)
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        images = [ccd.unbiased_and_trimmed_image(amp).getImage() for ccd in self.ccds]
+        imarr = imutils.stack(images).getArray()
+        imarr.flags.writeable = False
+
+        ## Evict least recently used arrays
+        self._cache[key] = imarr
+        self.nbytes += imarr.nbytes
+        while self.nbytes > self.max_size*1024**2 and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        return imarr
+
+class SharedAmpImages():
+    """Amplifier pixel arrays placed in a single shared memory block.
+
+    The owning process copies the amplifier arrays into shared memory with
+    `SharedAmpImages.from_images` and passes `spec` to worker processes, 
+    which use `SharedAmpImages.attach` to access the arrays without copying.
+    Arrays are read-only.
+
+    Parameters
+    ----------
+    shm : `multiprocessing.shared_memory.SharedMemory`
+        Shared memory block.
+    amps : `list`
+        Amplifier numbers.
+    shape : `tuple`
+        Shape of each amplifier pixel array.
+    dtype : `numpy.dtype`
+        Data type of the amplifier pixel arrays.
+    owner : `bool`
+        `True` if the shared memory block should be unlinked on close.
+    """
+
+    def __init__(self, shm, amps, shape, dtype, owner=False):
+
+        self._shm = shm
+        self.amps = list(amps)
+        self.owner = owner
+        self._index = {amp : n for n, amp in enumerate(self.amps)}
+        self._array = np.ndarray((len(self.amps),) + tuple(shape), dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def from_images(cls, amp_images, amps):
+        """Copy amplifier pixel arrays into a new shared memory block."""
+
+        amps = list(amps)
+        first = np.asarray(amp_images[amps[0]])
+        shm = shared_memory.SharedMemory(create=True, size=max(len(amps)*first.nbytes, 1))
+        shared = cls(shm, amps, first.shape, first.dtype, owner=True)
+        for n, amp in enumerate(amps):
+            shared._array[n] = amp_images[amp]
+        shared._array.flags.writeable = False
+
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        """Attach to an existing shared memory block."""
+
+        name, amps, shape, dtype = spec
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        shared = cls(shm, amps, shape, np.dtype(dtype))
+        shared._array.flags.writeable = False
+
+        return shared
+
+    @property
+    def spec(self):
+        """Picklable description used to attach to the shared memory block."""
+        return (self._shm.name, self.amps, self._array.shape[1:], self._array.dtype.str)
+
+    def __getitem__(self, amp):
+        return self._array[self._index[amp]]
+
+    def close(self):
+        """Release the shared memory block."""
+        self._array = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class StreamingCoadd():
+    """Bounded-memory per-pixel coadd of a sequence of images.
+
+    Images are added one at a time.  The mean is calculated exactly from a
+    running sum.  The median is approximated using the remedian: images are
+    buffered in chunks, each full chunk is replaced by its median and passed
+    to the next level, so only ``chunk_size`` images per level are held in 
+    memory.  The median is exact if no more than ``chunk_size`` images are 
+    added.
+
+    Parameters
+    ----------
+    statistic : `str`
+        Coadd statistic, either 'mean' or 'median'.
+    chunk_size : `int`
+        Number of images per median chunk.
+    """
+
+    def __init__(self, statistic='median', chunk_size=9):
+
+        if statistic not in ('mean', 'median'):
+            raise ValueError("Unknown coadd statistic: {0}".format(statistic))
+        self.statistic = statistic
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._sum = None
+        self._levels = []
+
+    def add(self, imarr):
+        """Add an image pixel array to the coadd."""
+
+        self.count += 1
+        if self.statistic == 'mean':
+            if self._sum is None:
+                self._sum = np.zeros(imarr.shape)
+            self._sum += imarr
+            return
+
+        item = np.array(imarr, dtype=np.float32)
+        for level in range(len(self._levels) + 1):
+            if level == len(self._levels):
+                self._levels.append([])
+            self._levels[level].append(item)
+            if len(self._levels[level]) < self.chunk_size:
+                break
+            item = np.median(np.stack(self._levels[level]), axis=0)
+            self._levels[level] = []
+
+    def result(self):
+        """Return the coadd pixel array."""
+
+        if self.count == 0:
+            raise ValueError("No images have been added to coadd.")
+        if self.statistic == 'mean':
+            return (self._sum/self.count).astype(np.float32)
+
+        ## Weight remaining chunk medians by number of images
+        arrays = []
+        weights = []
+        for level, items in enumerate(self._levels):
+            arrays.extend(items)
+            weights.extend([self.chunk_size**level]*len(items))
+        values = np.stack(arrays)
+        weights = np.asarray(weights, dtype=float)
+        if np.all(weights == weights[0]):
+            return np.median(values, axis=0)
+
+        order = np.argsort(values, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        index = np.argmax(cumulative >= 0.5*weights.sum(), axis=0)[np.newaxis]
+
+        return np.take_along_axis(np.take_along_axis(values, order, axis=0), index, axis=0)[0]
+
+def streaming_amp_stack(infiles, amps, bias_frame=None, dark_frame=None, linearity_correction=None,
+                        statistic='median', chunk_size=9, trim=True, num_workers=1):
+    """Make calibrated amplifier coadds, reading one exposure at a time.
+
+    Parameters
+    ----------
+    infiles : `list`
+        Input image FITS files.
+    amps : `list`
+        Amplifier numbers to coadd.
+    bias_frame : `str`, optional
+        Bias image FITS file for calibration.
+    dark_frame : `str`, optional
+        Dark image FITS file for calibration.
+    linearity_correction : optional
+        Linearity correction passed to `MaskedCCD`.
+    statistic : `str`
+        Coadd statistic, either 'mean' or 'median'.
+    chunk_size : `int`
+        Number of images per median chunk.
+    trim : `bool`
+        `True` to coadd unbiased and trimmed images, `False` to coadd 
+        bias-subtracted images.
+    num_workers : `int`
+        Number of worker processes; amplifiers are divided between workers.
+
+    Returns
+    -------
+    amp_images : `dict`
+        Coadd pixel arrays indexed by amplifier number.
+    """
+    amps = list(amps)
+    kwargs = {'bias_frame' : bias_frame, 'dark_frame' : dark_frame, 
+              'linearity_correction' : linearity_correction, 'statistic' : statistic,
+              'chunk_size' : chunk_size, 'trim' : trim}
+
+    if num_workers > 1 and len(amps) > 1:
+        amp_groups = [amps[n::num_workers] for n in range(min(num_workers, len(amps)))]
+        amp_images = {}
+        with ProcessPoolExecutor(max_workers=len(amp_groups)) as executor:
+            futures = [executor.submit(streaming_amp_stack, infiles, group, **kwargs) 
+                       for group in amp_groups]
+            for future in futures:
+                amp_images.update(future.result())
+        return amp_images
+
+    coadds = {amp : StreamingCoadd(statistic=statistic, chunk_size=chunk_size) for amp in amps}
+    for infile in infiles:
+        ccd = MaskedCCD(infile, bias_frame=bias_frame, dark_frame=dark_frame,
+                        linearity_correction=linearity_correction)
+        for amp in amps:
+            if trim:
+                image = ccd.unbiased_and_trimmed_image(amp).getImage()
+            else:
+                image = ccd.bias_subtracted_image(amp).getImage()
+            coadds[amp].add(image.getArray())
+        del ccd
+
+    return {amp : coadds[amp].result() for amp in amps}
+
 def calibrated_stack(infiles, outfile, bias_frame=None, dark_frame=None, 
-                     linearity_correction=None, bitpix=32):
-    """Make a calibrated coadd image and write FITS image file."""
+                     linearity_correction=None, bitpix=32, streaming=False,
+                     statistic='median', chunk_size=9, num_workers=1):
+    """Make a calibrated coadd image and write FITS image file.
+
+    If ``streaming`` is `True`, exposures are read one at a time and 
+    coadded using `StreamingCoadd` with the given statistic.
+    """
+
+    all_amps = imutils.allAmps(infiles[0])
+
+    if streaming:
+        amp_arrays = streaming_amp_stack(infiles, all_amps, bias_frame=bias_frame, 
+                                         dark_frame=dark_frame, 
+                                         linearity_correction=linearity_correction,
+                                         statistic=statistic, chunk_size=chunk_size, 
+                                         trim=False, num_workers=num_workers)
+        amp_images = {amp : afwImage.ImageF(amp_arrays[amp]) for amp in all_amps}
+        imutils.writeFits(amp_images, outfile, infiles[0], bitpix=bitpix)
+        return
 
     ccds = [MaskedCCD(infile, bias_frame=bias_frame, 
                       dark_frame=dark_frame, 
                       linearity_correction=linearity_correction) for infile in infiles]
 
-    all_amps = imutils.allAmps(infiles[0])
-
     amp_images = {}
     for amp in all_amps:
         amp_ims = [ccd.bias_subtracted_image(amp) for ccd in ccds]
@@ -126,6 +407,11 @@ class CrosstalkResults(widgets.VBox):
         out_box = widgets.Box([output])
         
         self.children = [output, controls]
+
+    @classmethod
+    def from_db(cls, session, sensor_name, agg, vic, **kwargs):
+        """Initialize from the result summary table of a database."""
+        return cls(query_summary(session, sensor_name, **kwargs), agg, vic)
         
     def update_agg(self, change):
         """Remove old lines from plot and plot new one"""
@@ -11,7 +11,7 @@ from lsst.obs.lsst.cameraTransforms import LsstCameraTransforms
 
 from mixcoatl.crosstalkTask import CrosstalkSpotTask
 
-def main(raft_id, database, main_dir, calib_dir, output_dir='./'):
+def main(raft_id, database, main_dir, calib_dir, output_dir='./', force=False):
 
     logfile = database.replace('.db', '.log')
     logging.basicConfig(filename=logfile, level=logging.INFO)
@@ -42,6 +42,7 @@ def main(raft_id, database, main_dir, calib_dir, output_dir='./'):
         for infile in infiles:
             crosstalk_task = CrosstalkSpotTask()
             crosstalk_task.config.database = database
+            crosstalk_task.config.skip_processed = not force
             crosstalk_task.run(central_sensor, infile, bias_frame=bias_frames[central_sensor])
 
 if __name__ == '__main__':
@@ -57,7 +58,9 @@ if __name__ == '__main__':
                         help='Directory containing calibration products.')
     parser.add_argument('--output_dir', '-o', type=str, default='./',
                         help='Output directory for analysis products.')
+    parser.add_argument('--force', action='store_true',
+                        help='Reprocess input files already in the provenance table.')
     args = parser.parse_args()
 
     main(args.raft_id, args.database, args.main_dir, args.calib_dir,
-         output_dir=args.output_dir)
+         output_dir=args.output_dir, force=args.force)
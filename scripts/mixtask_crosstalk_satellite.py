@@ -4,7 +4,8 @@ import logging
 from datetime import datetime
 from mixcoatl.crosstalkTask import CrosstalkSatelliteTask
 
-def main(sensor_name, infiles, database, bias_frame=None, dark_frame=None, logfile=None):
+def main(sensor_name, infiles, database, bias_frame=None, dark_frame=None, logfile=None, 
+         spool_dir=None, use_shards=False, force=False):
 
     if logfile is None:
         logfile = database.replace('.db', '.log')
@@ -13,6 +14,9 @@ def main(sensor_name, infiles, database, bias_frame=None, dark_frame=None, logfi
     logging.info("{0}  Running mixtask_crosstalk_satellite.py".format(datetime.now()))
     crosstalk_task = CrosstalkSatelliteTask()
     crosstalk_task.config.database = database
+    crosstalk_task.config.spool_dir = spool_dir
+    crosstalk_task.config.use_shards = use_shards
+    crosstalk_task.config.skip_processed = not force
     crosstalk_task.run(sensor_name, infiles, bias_frame=bias_frame, dark_frame=dark_frame)
     logging.info("{0}  Script completed successfully".format(datetime.now()))
 
@@ -31,7 +35,14 @@ if __name__ == '__main__':
                         help="Dark image FITS file for calibration")
     parser.add_argument('--log', '-l', type=str, default=None,
                         help="Optional log file to record script information.")
+    parser.add_argument('--spool_dir', '-s', type=str, default=None,
+                        help="Spool directory for results (see mixtask_ingest_spool.py).")
+    parser.add_argument('--use_shards', action='store_true',
+                        help="Write results to a per-job shard database (see mixtask_merge_databases.py).")
+    parser.add_argument('--force', action='store_true',
+                        help="Reprocess input files already in the provenance table.")
     args = parser.parse_args()
 
     main(args.sensor_name, args.infiles, args.database, bias_frame=args.bias_frame, 
-         dark_frame=args.dark_frame, logfile=args.log)
+         dark_frame=args.dark_frame, logfile=args.log, spool_dir=args.spool_dir, 
+         use_shards=args.use_shards, force=args.force)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+import argparse
+import logging
+from os.path import join
+from datetime import datetime
+from mixcoatl.gridFitTask import GridFitTask
+
+def main(sensor_id, infiles, brute_search=False, ccd_type=None, optics_grid_file=None,
+         output_dir='./', vary_theta=False, num_workers=1, summary_file=None, output_mode='full',
+         logfile=None):
+
+    if logfile is None:
+        logfile = join(output_dir, '{0}_gridfit.log'.format(sensor_id))
+
+    os.makedirs(output_dir, exist_ok=True)
+    logging.basicConfig(filename=logfile, level=logging.INFO)
+    logging.info("{0}  Running mixtask_gridfit_batch.py".format(datetime.now()))
+
+    ## Configure and run task
+    gridfit_task = GridFitTask()
+    gridfit_task.config.brute_search = brute_search
+    gridfit_task.config.vary_theta = vary_theta
+    gridfit_task.config.output_mode = output_mode
+    gridfit_task.config.num_workers = num_workers
+
+    summary = gridfit_task.run_batch(infiles, ccd_type=ccd_type,
+                                     optics_grid_file=optics_grid_file,
+                                     output_dir=output_dir,
+                                     summary_file=summary_file)
+
+    nfailed = len(summary.data) - sum(summary.data['SUCCESS'])
+    logging.info("{0}  Fit {1} catalogs for {2}, {3} failed.".format(datetime.now(), len(summary.data),
+                                                                     sensor_id, nfailed))
+    logging.info("{0}  Script completed successfully".format(datetime.now()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run GridFitTask on a grid scan sequence.')
+    parser.add_argument('sensor_id', type=str, 
+                        help='CCD identifier (e.g. R22_S11).')
+    parser.add_argument('infiles', type=str, nargs='+',
+                        help='Input catalog files to process.')
+    parser.add_argument('--brute', action='store_true',
+                        help='Flag to enable intial brute search.')
+    parser.add_argument('--ccd_type', type=str, default=None,
+                        help='CCD manufacturer type (ITL or E2V).')
+    parser.add_argument('--optics_grid_file', type=str, default=None,
+                        help='FITS or CAT file with optic shifts.')
+    parser.add_argument('--output_dir', '-o', type=str, default='./',
+                        help='Output directory for analysis products.')
+    parser.add_argument('--vary_theta', action='store_true',
+                        help='Flag to enable theta variation during fit.')
+    parser.add_argument('--num_workers', '-n', type=int, default=1,
+                        help='Number of processes for grid fits.')
+    parser.add_argument('--summary_file', type=str, default=None,
+                        help='FITS file for summary table of fit results.')
+    parser.add_argument('--output_mode', type=str, default='full',
+                        help='Output mode (full, sidecar or append).')
+    parser.add_argument('--log', '-l', type=str, default=None,
+                        help='Optional log file to record script information.')
+    args = parser.parse_args()
+
+    main(args.sensor_id, args.infiles, brute_search=args.brute,
+         ccd_type=args.ccd_type, optics_grid_file=args.optics_grid_file,
+         output_dir=args.output_dir, vary_theta=args.vary_theta,
+         num_workers=args.num_workers, summary_file=args.summary_file,
+         output_mode=args.output_mode, logfile=args.log)
@@ -1,39 +1,27 @@
 #!/usr/bin/env python
 import argparse
 import os
-from astropy.io import fits
-import numpy as np
 
 from lsst.obs.lsst import LsstCamMapper as camMapper
 from lsst.obs.lsst.cameraTransforms import LsstCameraTransforms
 
-from mixcoatl.gridFitTask import GridFitTask
+from mixcoatl.gridFitTask import GridFitTask, grid_center_guess
 
 def main(sensor_id, infile, brute_search=False, ccd_type=None, dx0=0., dy0=0.,
-         optics_grid_file=None, output_dir='./', vary_theta=False):
+         optics_grid_file=None, output_dir='./', vary_theta=False, output_mode='full'):
 
     basename = os.path.basename(infile)
     root = os.path.splitext(basename)[0]
     outfile = os.path.join(output_dir, '{0}_gridfit.cat'.format(root))
 
     ## Make initial grid center guess
-    with fits.open(infile) as src:
-
-        all_srcY = src[1].data['base_SdssCentroid_Y']
-        all_srcX = src[1].data['base_SdssCentroid_X']
-
-        mask = (src[1].data['base_SdssShape_XX'] > 4.5) \
-            *(src[1].data['base_SdssShape_XX'] < 7.) \
-            *(src[1].data['base_SdssShape_YY'] > 4.5) \
-            *(src[1].data['base_SdssShape_YY'] < 7.)
-
-        y0_guess = np.nanmedian(all_srcY[mask])
-        x0_guess = np.nanmedian(all_srcX[mask])
+    y0_guess, x0_guess = grid_center_guess(infile)
 
     ## Configure and run task
     gridfit_task = GridFitTask()
     gridfit_task.config.brute_search = brute_search
     gridfit_task.config.vary_theta = vary_theta
+    gridfit_task.config.output_mode = output_mode
     gridfit_task.config.outfile = outfile
     
     grid, result = gridfit_task.run(infile, (y0_guess, x0_guess),
@@ -61,9 +49,12 @@ if __name__ == '__main__':
                         help='Output directory for analysis products.')
     parser.add_argument('--vary_theta', action='store_true',
                         help='Flag to enable theta variation during fit.')
+    parser.add_argument('--output_mode', type=str, default='full',
+                        help='Output mode (full, sidecar or append).')
     args = parser.parse_args()
 
     main(args.sensor_id, args.infile, brute_search=args.brute,
          ccd_type=args.ccd_type, dx0=args.dx0, dy0=args.dy0,
          optics_grid_file=args.optics_grid_file,
-         output_dir=args.output_dir, vary_theta=args.vary_theta)
+         output_dir=args.output_dir, vary_theta=args.vary_theta,
+         output_mode=args.output_mode)
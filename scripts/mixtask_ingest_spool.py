@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+import argparse
+import logging
+from datetime import datetime
+from mixcoatl.ingest import IngestionService
+
+def main(database, spool_dir, poll_interval=5., max_idle=None, pragmas=False, logfile=None):
+
+    if logfile is None:
+        logfile = database.replace('.db', '.log')
+
+    logging.basicConfig(filename=logfile, level=logging.INFO)
+    logging.info("{0}  Running mixtask_ingest_spool.py".format(datetime.now()))
+    service = IngestionService(database, spool_dir, poll_interval=poll_interval, pragmas=pragmas)
+    service.run(max_idle=max_idle)
+    logging.info("{0}  Ingested {1} results".format(datetime.now(), service.nrows))
+    logging.info("{0}  Script completed successfully".format(datetime.now()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Ingest crosstalk results from a spool directory into a database.")
+    parser.add_argument('database', type=str,
+                        help="SQL database DB file for analysis output products.")
+    parser.add_argument('spool_dir', type=str,
+                        help="Spool directory written to by crosstalk tasks.")
+    parser.add_argument('--poll_interval', '-p', type=float, default=5.,
+                        help="Time (seconds) between polls of the spool directory.")
+    parser.add_argument('--max_idle', '-m', type=float, default=None,
+                        help="Stop after the spool directory is empty for this time (seconds).")
+    parser.add_argument('--pragmas', action='store_true',
+                        help="Apply SQLite performance pragmas to database.")
+    parser.add_argument('--log', '-l', type=str, default=None,
+                        help="Optional log file to record script information.")
+    args = parser.parse_args()
+
+    main(args.database, args.spool_dir, poll_interval=args.poll_interval, max_idle=args.max_idle,
+         pragmas=args.pragmas, logfile=args.log)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+import argparse
+import logging
+from datetime import datetime
+from mixcoatl.database import merge_databases
+
+def main(database, shards, pragmas=False, logfile=None):
+
+    if logfile is None:
+        logfile = database.replace('.db', '.log')
+
+    logging.basicConfig(filename=logfile, level=logging.INFO)
+    logging.info("{0}  Running mixtask_merge_databases.py".format(datetime.now()))
+    nrows = merge_databases(database, shards, pragmas=pragmas)
+    logging.info("{0}  Merged {1} results from {2} shards".format(datetime.now(), nrows, len(shards)))
+    logging.info("{0}  Script completed successfully".format(datetime.now()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Merge shard databases into a master database.")
+    parser.add_argument('database', type=str,
+                        help="Master SQL database DB file.")
+    parser.add_argument('shards', type=str, nargs='+',
+                        help="Shard SQL database DB files.")
+    parser.add_argument('--pragmas', action='store_true',
+                        help="Apply SQLite performance pragmas to master database.")
+    parser.add_argument('--log', '-l', type=str, default=None,
+                        help="Optional log file to record script information.")
+    args = parser.parse_args()
+
+    main(args.database, args.shards, pragmas=args.pragmas, logfile=args.log)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import argparse
+import os
+
+from mixcoatl.sourcegrid import build_optics_grid
+
+def main(infiles, outfile, iterate=False, ccd_type=None, optics_grid_file=None, 
+         output_dir='./', num_workers=1, max_iter=5, min_count=3):
+
+    if iterate:
+
+        ## Fit source catalogs and update shifts until convergence
+        from mixcoatl.gridFitTask import GridFitTask
+
+        gridfit_task = GridFitTask()
+        gridfit_task.config.num_workers = num_workers
+        gridfit_task.config.optics_max_iter = max_iter
+        gridfit_task.config.optics_min_count = min_count
+        final_file, grid = gridfit_task.run_optics_grid(infiles, ccd_type=ccd_type,
+                                                        optics_grid_file=optics_grid_file,
+                                                        output_dir=output_dir)
+        grid.write_fits(os.path.join(output_dir, outfile), overwrite=True)
+    else:
+
+        ## Build shifts from existing grid fit catalogs
+        grid, builder = build_optics_grid(infiles, outfile=os.path.join(output_dir, outfile),
+                                          min_count=min_count)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build optics grid of normalized centroid shifts.')
+    parser.add_argument('infiles', type=str, nargs='+',
+                        help='Grid fit catalogs (or source catalogs with --iterate).')
+    parser.add_argument('--outfile', type=str, default='optics_grid.fits',
+                        help='Output FITS filename.')
+    parser.add_argument('--iterate', action='store_true',
+                        help='Flag to iterate grid fits and shift updates to convergence.')
+    parser.add_argument('--ccd_type', type=str, default=None,
+                        help='CCD manufacturer type (ITL or E2V).')
+    parser.add_argument('--optics_grid_file', type=str, default=None,
+                        help='FITS file with initial optic shifts.')
+    parser.add_argument('--output_dir', '-o', type=str, default='./',
+                        help='Output directory for analysis products.')
+    parser.add_argument('--num_workers', '-n', type=int, default=1,
+                        help='Number of processes for grid fits.')
+    parser.add_argument('--max_iter', type=int, default=5,
+                        help='Maximum number of iterations.')
+    parser.add_argument('--min_count', type=int, default=3,
+                        help='Minimum number of shifts for a grid source.')
+    args = parser.parse_args()
+
+    main(args.infiles, args.outfile, iterate=args.iterate, ccd_type=args.ccd_type,
+         optics_grid_file=args.optics_grid_file, output_dir=args.output_dir,
+         num_workers=args.num_workers, max_iter=args.max_iter, min_count=args.min_count)
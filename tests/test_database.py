@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from mixcoatl.database import (db_session, dispose_engines, get_or_create_sensor, query_matrix,
+                               query_summary, Result, ResultSummary, ResultWriter)
+
+SEGMENTS = {1 : 'C10', 2 : 'C11'}
+
+class ResultWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, 'test.db')
+
+    def tearDown(self):
+
+        dispose_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def write_batches(self, batches):
+        """Write each batch of coefficients and flush."""
+
+        with db_session(self.database) as session:
+            sensor = get_or_create_sensor(session, 'R22/S11', 'ITL-3800C-000', 'ITL', SEGMENTS)
+            writer = ResultWriter(session, sensor, methodology='MODEL_LSQ', image_type='spot')
+            for coefficients in batches:
+                writer.add_row(1, [2]*len(coefficients), 50000., coefficients,
+                               [1.E-6]*len(coefficients))
+                writer.flush()
+
+    def test_flush_nonfinite_batch(self):
+        """Test that batches of only non-finite results add no summary rows."""
+
+        self.write_batches([[np.nan, np.nan], [np.inf]])
+
+        with db_session(self.database) as session:
+            self.assertEqual(session.query(Result).count(), 3)
+            self.assertEqual(session.query(ResultSummary).count(), 0)
+
+    def test_flush_summary(self):
+        """Test that non-finite results are left out of the summary."""
+
+        self.write_batches([[1.E-4, np.nan], [3.E-4], [np.nan]])
+
+        with db_session(self.database) as session:
+            summary = session.query(ResultSummary).one()
+            self.assertEqual(summary.count, 2)
+            self.assertAlmostEqual(summary.sum_weighted_coefficient/summary.sum_weight, 2.E-4)
+
+    def test_query_matrix_summary(self):
+        """Test that matrix summaries leave out non-finite results."""
+
+        self.write_batches([[1.E-4, np.nan], [np.inf]])
+
+        with db_session(self.database) as session:
+            matrix = query_matrix(session, 'R22/S11', summary=True)
+            summary = query_summary(session, 'R22/S11')
+        self.assertEqual(matrix['count'][0, 1], 1)
+        self.assertAlmostEqual(matrix['coefficient'][0, 1], 1.E-4)
+        self.assertAlmostEqual(summary[(1, 2)][1][0], matrix['coefficient'][0, 1])
+
+if __name__ == '__main__':
+    unittest.main()